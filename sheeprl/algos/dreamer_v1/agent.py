@@ -1,11 +1,13 @@
-from typing import Any, Dict, Optional, Sequence, Tuple
+from contextlib import contextmanager, nullcontext
+from math import prod
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
 
-import numpy as np
 import torch
+import torch.nn.functional as F
 from lightning.fabric import Fabric
 from lightning.fabric.wrappers import _FabricModule
 from torch import Tensor, nn
-from torch.distributions import Normal, OneHotCategorical
+from torch.distributions import Distribution
 
 from sheeprl.algos.dreamer_v1.args import DreamerV1Args
 from sheeprl.algos.dreamer_v1.utils import compute_stochastic_state
@@ -13,6 +15,31 @@ from sheeprl.algos.dreamer_v2.agent import Actor, CNNDecoder, CNNEncoder, Minedo
 from sheeprl.models.models import MLP, MultiDecoder, MultiEncoder
 from sheeprl.utils.utils import init_weights
 
+# Whether to use the TorchScript profiling executor for the modules scripted by the player.
+# It is disabled by default to avoid the re-compilations triggered
+# by the first calls of the scripted modules.
+JIT_PROFILING_EXECUTOR = False
+
+
+@contextmanager
+def _jit_profiling_executor(enabled: bool) -> Iterator[None]:
+    """Select the TorchScript executor only inside the context, restoring the previous one when exiting.
+    The executor is a process-wide setting, which is read when a scripted function is run for the first time:
+    scoping it avoids changing the executor of the scripted functions used elsewhere (e.g. during the training).
+
+    Args:
+        enabled (bool): whether to use the profiling executor.
+    """
+    previous = torch._C._jit_set_profiling_executor(enabled)
+    try:
+        yield
+    finally:
+        torch._C._jit_set_profiling_executor(previous)
+
+
+# The activation functions that can be selected through the `cnn_act` and `dense_act` arguments
+ACTIVATIONS: Dict[str, Type[nn.Module]] = {name: getattr(nn, name) for name in nn.modules.activation.__all__}
+
 
 class RecurrentModel(nn.Module):
     """
@@ -27,8 +54,19 @@ class RecurrentModel(nn.Module):
 
     def __init__(self, input_size: int, recurrent_state_size: int, activation: nn.Module = nn.ELU) -> None:
         super().__init__()
-        self.mlp = nn.Sequential(nn.Linear(input_size, recurrent_state_size), activation())
+        self.linear = nn.Linear(input_size, recurrent_state_size)
+        self.activation = activation()
         self.rnn = nn.GRU(recurrent_state_size, recurrent_state_size)
+        self.rnn.flatten_parameters()
+        self._register_load_state_dict_pre_hook(self._load_mlp_state_dict)
+
+    @staticmethod
+    def _load_mlp_state_dict(state_dict: Dict[str, Tensor], prefix: str, *args: Any) -> None:
+        """Rename the parameters of the checkpoints where the linear layer was wrapped in a `nn.Sequential`."""
+        for name in ("weight", "bias"):
+            old_key = prefix + "mlp.0." + name
+            if old_key in state_dict:
+                state_dict[prefix + "linear." + name] = state_dict.pop(old_key)
 
     def forward(self, input: Tensor, recurrent_state: Tensor) -> Tuple[Tensor, Tensor]:
         """
@@ -41,11 +79,36 @@ class RecurrentModel(nn.Module):
         Returns:
             the computed recurrent output and recurrent state.
         """
-        feat = self.mlp(input)
-        self.rnn.flatten_parameters()
+        feat = self.activation(self.linear(input))
         out, recurrent_state = self.rnn(feat, recurrent_state)
         return out, recurrent_state
 
+    @torch.jit.export
+    def forward_step(self, input: Tensor, recurrent_state: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Compute a single step of the recurrent model with a GRU cell, which shares the weights of the GRU.
+        It avoids the overhead of the cuDNN GRU for sequences of length 1, like the ones seen by the player.
+
+        Args:
+            input (Tensor): the input tensor composed by the stochastic state and the actions concatenated together.
+                Shape (1, batch_size, input_size).
+            recurrent_state (Tensor): the previous recurrent state.
+                Shape (1, batch_size, recurrent_state_size).
+
+        Returns:
+            the computed recurrent output and recurrent state.
+        """
+        feat = self.activation(self.linear(input))
+        recurrent_state = torch.gru_cell(
+            feat.squeeze(0),
+            recurrent_state.squeeze(0),
+            self.rnn.weight_ih_l0,
+            self.rnn.weight_hh_l0,
+            self.rnn.bias_ih_l0,
+            self.rnn.bias_hh_l0,
+        ).unsqueeze(0)
+        return recurrent_state, recurrent_state
+
 
 class RSSM(nn.Module):
     """RSSM model for the model-base DreamerV1 agent.
@@ -116,6 +179,35 @@ class RSSM(nn.Module):
         posterior_mean_std, posterior = self._representation(recurrent_state, embedded_obs)
         return recurrent_state, posterior, prior, posterior_mean_std, prior_state_mean_std
 
+    def dynamic_posterior(
+        self,
+        posterior: Tensor,
+        recurrent_state: Tensor,
+        action: Tensor,
+        embedded_obs: Tensor,
+    ) -> Tuple[Tensor, Tensor, Tuple[Tensor, Tensor]]:
+        """
+        Perform one step of the dynamic learning without the transition model.
+        Since the prior state depends only on the recurrent state, the priors of a whole sequence
+        can be computed with a single call to the transition model on the stacked recurrent states.
+
+        Args:
+            posterior (Tensor): the posterior state.
+            recurrent_state (Tensor): a tuple representing the recurrent state of the recurrent model.
+            action (Tensor): the action taken by the agent.
+            embedded_obs (Tensor): the embedded observations provided by the environment.
+
+        Returns:
+            The recurrent state (Tensor): the recurrent state of the recurrent model.
+            The posterior state (Tensor): computed by the representation model
+            from the recurrent state and the embedded observation.
+            The posterior mean and std (Tuple[Tensor, Tensor]): the posterior mean and std of
+            the distribution of the posterior state.
+        """
+        _, recurrent_state = self.recurrent_model(torch.cat((posterior, action), -1), recurrent_state)
+        posterior_mean_std, posterior = self._representation(recurrent_state, embedded_obs)
+        return recurrent_state, posterior, posterior_mean_std
+
     def _representation(self, recurrent_state: Tensor, embedded_obs: Tensor) -> Tuple[Tuple[Tensor, Tensor], Tensor]:
         """Compute the distribution of the posterior state.
 
@@ -171,6 +263,48 @@ class RSSM(nn.Module):
         _, imagined_prior = self._transition(recurrent_output)
         return imagined_prior, recurrent_state
 
+    def imagine_trajectory(
+        self,
+        stochastic_state: Tensor,
+        recurrent_state: Tensor,
+        actor: nn.Module,
+        horizon: int,
+        return_actions: bool = False,
+    ) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+        """Imagine the trajectories in the latent space, starting from the given states and following
+        the actions selected by the actor, up to the horizon.
+
+        Args:
+            stochastic_state (Tensor): the starting stochastic states.
+                Shape (1, batch_size, stochastic_size).
+            recurrent_state (Tensor): the starting recurrent states.
+                Shape (1, batch_size, recurrent_state_size).
+            actor (nn.Module): the actor that selects the actions from the latent states.
+            horizon (int): the number of imagination steps.
+            return_actions (bool): whether to return also the actions selected by the actor at every step.
+                Default to False.
+
+        Returns:
+            The imagined latent states (Tensor), i.e., the concatenation of the stochastic
+            and recurrent states, of shape (horizon, batch_size, stochastic_size + recurrent_state_size).
+            If `return_actions` is True, also the imagined actions (Tensor),
+            of shape (horizon, batch_size, sum(actions_dim)).
+        """
+        # The states of every step are concatenated at the end,
+        # instead of being copied one at a time into a pre-allocated tensor tracked by the autograd
+        latent_state = torch.cat((stochastic_state, recurrent_state), -1)
+        imagined_trajectories: List[Tensor] = []
+        imagined_actions: List[Tensor] = []
+        for _ in range(horizon):
+            actions = torch.cat(actor(latent_state.detach())[0], dim=-1)
+            imagined_actions.append(actions)
+            stochastic_state, recurrent_state = self.imagination(stochastic_state, recurrent_state, actions)
+            latent_state = torch.cat((stochastic_state, recurrent_state), -1)
+            imagined_trajectories.append(latent_state)
+        if return_actions:
+            return torch.cat(imagined_trajectories, 0), torch.cat(imagined_actions, 0)
+        return torch.cat(imagined_trajectories, 0)
+
 
 class WorldModel(nn.Module):
     """Wrapper class for the World model.
@@ -203,7 +337,7 @@ class PlayerDV1(nn.Module):
     """The model of the DreamerV1 player.
 
     Args:
-        encoder (nn.Module): the encoder.
+        encoder (nn.Module): the encoder, it must provide the `forward_into` method of the MultiEncoder.
         recurrent_model (nn.Module): the recurrent model.
         representation_model (nn.Module): the representation model.
         actor (nn.Module): the actor.
@@ -213,6 +347,18 @@ class PlayerDV1(nn.Module):
         stochastic_size (int): the size of the stochastic state.
         recurrent_state_size (int): the size of the recurrent state.
         device (torch.device): the device to work on.
+        jit_inference (bool): whether to compile with TorchScript the scriptable models used
+            to select the actions. The scripted models share the parameters with the original ones,
+            so they are always up to date with the training. They are run with the executor selected by
+            `JIT_PROFILING_EXECUTOR`, which is set only while the player computes the actions.
+            Default to False.
+        cuda_graph (bool): whether to capture the computation of the greedy actions in a CUDA graph,
+            which is replayed at every step. It is used only if the device is a CUDA device
+            and no action mask is given.
+            Default to False.
+        bf16 (bool): whether to compute the actions with bfloat16 mixed precision.
+            The states and the actions are kept in single precision.
+            Default to False.
     """
 
     def __init__(
@@ -227,20 +373,32 @@ class PlayerDV1(nn.Module):
         stochastic_size: int,
         recurrent_state_size: int,
         device: torch.device,
+        jit_inference: bool = False,
+        cuda_graph: bool = False,
+        bf16: bool = False,
     ) -> None:
         super().__init__()
+        if jit_inference:
+            recurrent_model = torch.jit.script(recurrent_model)
+            representation_model = torch.jit.script(representation_model)
         self.encoder = encoder
         self.recurrent_model = recurrent_model
         self.representation_model = representation_model
         self.actor = actor
+        self.jit_inference = jit_inference
+        self.cuda_graph = cuda_graph and torch.device(device).type == "cuda"
+        self._graph: Optional[torch.cuda.CUDAGraph] = None
+        self.bf16 = bf16
         self.device = device
         self.expl_amount = expl_amount
         self.actions_dim = actions_dim
+        self._total_action_dim = int(sum(actions_dim))
         self.stochastic_size = stochastic_size
         self.recurrent_state_size = recurrent_state_size
         self.num_envs = num_envs
         self.init_states()
 
+    @torch.inference_mode()
     def init_states(self, reset_envs: Optional[Sequence[int]] = None) -> None:
         """Initialize the states and the actions for the ended environments.
 
@@ -250,14 +408,30 @@ class PlayerDV1(nn.Module):
                 Defaults to None.
         """
         if reset_envs is None or len(reset_envs) == 0:
-            self.actions = torch.zeros(1, self.num_envs, np.sum(self.actions_dim), device=self.device)
+            self.actions = torch.zeros(1, self.num_envs, self._total_action_dim, device=self.device)
             self.recurrent_state = torch.zeros(1, self.num_envs, self.recurrent_state_size, device=self.device)
             self.stochastic_state = torch.zeros(1, self.num_envs, self.stochastic_size, device=self.device)
+            # Buffers where the inputs of the models are concatenated, reused at every step
+            self._recurrent_input = torch.empty(
+                1, self.num_envs, self.stochastic_size + self._total_action_dim, device=self.device
+            )
+            self._representation_input = torch.empty(
+                1, self.num_envs, self.recurrent_state_size + self.encoder.output_dim, device=self.device
+            )
+            self._actor_input = torch.empty(
+                1, self.num_envs, self.stochastic_size + self.recurrent_state_size, device=self.device
+            )
+            # Buffer of the uniform samples that select which environments take a random action
+            self._expl_uniform = torch.empty(1, self.num_envs, 1, device=self.device)
+            # The captured graph is bound to the shapes of the states
+            self._graph = None
         else:
-            self.actions[:, reset_envs] = torch.zeros_like(self.actions[:, reset_envs])
-            self.recurrent_state[:, reset_envs] = torch.zeros_like(self.recurrent_state[:, reset_envs])
-            self.stochastic_state[:, reset_envs] = torch.zeros_like(self.stochastic_state[:, reset_envs])
+            # Fill in-place with a scalar, without allocating the zero tensors to copy
+            self.actions[:, reset_envs] = 0.0
+            self.recurrent_state[:, reset_envs] = 0.0
+            self.stochastic_state[:, reset_envs] = 0.0
 
+    @torch.inference_mode()
     def get_exploration_action(
         self, obs: Tensor, is_continuous: bool, mask: Optional[Dict[str, Tensor]] = None
     ) -> Sequence[Tensor]:
@@ -276,18 +450,22 @@ class PlayerDV1(nn.Module):
         if is_continuous:
             self.actions = torch.cat(actions, -1)
             if self.expl_amount > 0.0:
-                self.actions = torch.clip(Normal(self.actions, self.expl_amount).sample(), -1, 1)
+                # Equivalent to sampling from Normal(self.actions, self.expl_amount), without the distribution object
+                noise = torch.empty_like(self.actions).normal_(0, self.expl_amount)
+                self.actions = self.actions.add_(noise).clamp_(-1, 1)
             expl_actions = [self.actions]
         else:
             expl_actions = []
             for act in actions:
-                sample = OneHotCategorical(logits=torch.zeros_like(act)).sample().to(self.device)
-                expl_actions.append(
-                    torch.where(torch.rand(act.shape[:1], device=self.device) < self.expl_amount, sample, act)
-                )
+                # Uniformly sampled one-hot actions
+                idxes = torch.randint(act.shape[-1], act.shape[:-1], device=act.device)
+                sample = F.one_hot(idxes, act.shape[-1]).to(act.dtype)
+                # Every environment takes the random action independently with probability `expl_amount`
+                expl_actions.append(torch.where(self._expl_uniform.uniform_() < self.expl_amount, sample, act))
             self.actions = torch.cat(expl_actions, -1)
         return tuple(expl_actions)
 
+    @torch.inference_mode()
     def get_greedy_action(
         self, obs: Tensor, is_training: bool = True, mask: Optional[Dict[str, Tensor]] = None
     ) -> Sequence[Tensor]:
@@ -302,15 +480,98 @@ class PlayerDV1(nn.Module):
 
         Returns:
             The actions the agent has to perform (Sequence[Tensor]).
+
+        Note:
+            The actions are computed in inference mode, so the states of the player
+            are inference tensors and are created and reset in inference mode too.
         """
-        embedded_obs = self.encoder(obs)
-        _, self.recurrent_state = self.recurrent_model(
-            torch.cat((self.stochastic_state, self.actions), -1), self.recurrent_state
+        if self.cuda_graph and not mask:
+            return self._replay_greedy_action(obs, is_training)
+        self.recurrent_state, self.stochastic_state, actions = self._greedy_step(
+            obs, self.stochastic_state, self.recurrent_state, self.actions, is_training, mask
         )
-        _, self.stochastic_state = compute_stochastic_state(
-            self.representation_model(torch.cat((self.recurrent_state, embedded_obs), -1))
-        )
-        actions, _ = self.actor(torch.cat((self.stochastic_state, self.recurrent_state), -1), is_training, mask)
+        self.actions = torch.cat(actions, -1)
+        return actions
+
+    def _greedy_step(
+        self,
+        obs: Dict[str, Tensor],
+        stochastic_state: Tensor,
+        recurrent_state: Tensor,
+        actions: Tensor,
+        is_training: bool = True,
+        mask: Optional[Dict[str, Tensor]] = None,
+    ) -> Tuple[Tensor, Tensor, Sequence[Tensor]]:
+        """Compute the next latent state and the greedy actions from the previous latent state and actions.
+
+        Returns:
+            The recurrent state (Tensor).
+            The stochastic state (Tensor).
+            The actions the agent has to perform (Sequence[Tensor]).
+        """
+        jit_executor = _jit_profiling_executor(JIT_PROFILING_EXECUTOR) if self.jit_inference else nullcontext()
+        with jit_executor, torch.autocast(
+            device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.bf16
+        ):
+            # The embedded observations are written directly into the input buffer of the representation model
+            self.encoder.forward_into(obs, self._representation_input[..., self.recurrent_state_size :])
+            _, recurrent_state = self.recurrent_model.forward_step(
+                torch.cat((stochastic_state, actions), -1, out=self._recurrent_input), recurrent_state
+            )
+            self._representation_input[..., : self.recurrent_state_size].copy_(recurrent_state)
+            _, stochastic_state = compute_stochastic_state(self.representation_model(self._representation_input))
+            actions, _ = self.actor(
+                torch.cat((stochastic_state, recurrent_state), -1, out=self._actor_input), is_training, mask
+            )
+        if self.bf16:
+            # The states and the actions are stored in full precision
+            recurrent_state = recurrent_state.float()
+            stochastic_state = stochastic_state.float()
+            actions = tuple(act.float() for act in actions)
+        return recurrent_state, stochastic_state, actions
+
+    def _capture_greedy_action(self, obs: Dict[str, Tensor], is_training: bool) -> None:
+        """Capture the computation of the greedy actions in a CUDA graph,
+        reading from and writing to static tensors.
+        """
+        self._graph_obs = {k: v.clone() for k, v in obs.items()}
+        self._graph_states = (self.stochastic_state.clone(), self.recurrent_state.clone(), self.actions.clone())
+        # The validation of the distributions' arguments synchronizes with the host,
+        # which is not allowed during the capture
+        validate_args = Distribution._validate_args
+        Distribution.set_default_validate_args(False)
+        try:
+            # Warm up on a side stream before the capture
+            stream = torch.cuda.Stream(self.device)
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._greedy_step(self._graph_obs, *self._graph_states, is_training)
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                self._graph_outputs = self._greedy_step(self._graph_obs, *self._graph_states, is_training)
+        finally:
+            Distribution.set_default_validate_args(validate_args)
+        self._graph_is_training = is_training
+
+    def _replay_greedy_action(self, obs: Dict[str, Tensor], is_training: bool) -> Sequence[Tensor]:
+        """Compute the greedy actions by replaying the captured CUDA graph.
+        The graph is captured at the first call, after every reset of all the states,
+        and whenever `is_training` changes.
+        """
+        if self._graph is None or self._graph_is_training != is_training:
+            self._capture_greedy_action(obs, is_training)
+        for k, v in obs.items():
+            self._graph_obs[k].copy_(v)
+        for static_state, state in zip(self._graph_states, (self.stochastic_state, self.recurrent_state, self.actions)):
+            static_state.copy_(state)
+        self._graph.replay()
+        recurrent_state, stochastic_state, actions = self._graph_outputs
+        # The outputs of the graph are overwritten at every replay
+        self.recurrent_state = recurrent_state.clone()
+        self.stochastic_state = stochastic_state.clone()
+        actions = tuple(act.clone() for act in actions)
         self.actions = torch.cat(actions, -1)
         return actions
 
@@ -355,15 +616,15 @@ def build_models(
     if args.dense_units <= 0:
         raise ValueError(f"dense_units must be greater than zero, given {args.dense_units}")
     try:
-        cnn_act = getattr(nn, args.cnn_act)
-    except AttributeError:
+        cnn_act = ACTIVATIONS[args.cnn_act]
+    except KeyError:
         raise ValueError(
             f"Invalid value for cnn_act, given {args.cnn_act}, "
             "must be one of https://pytorch.org/docs/stable/nn.html#non-linear-activations-weighted-sum-nonlinearity"
         )
     try:
-        dense_act = getattr(nn, args.dense_act)
-    except AttributeError:
+        dense_act = ACTIVATIONS[args.dense_act]
+    except KeyError:
         raise ValueError(
             f"Invalid value for dense_act, given {args.dense_act}, "
             "must be one of https://pytorch.org/docs/stable/nn.html#non-linear-activations-weighted-sum-nonlinearity"
@@ -372,12 +633,13 @@ def build_models(
     # Sizes
     latent_state_size = args.stochastic_size + args.recurrent_state_size
     mlp_dims = [obs_space[k].shape[0] for k in mlp_keys]
+    cnn_channels = [prod(obs_space[k].shape[:-2]) for k in cnn_keys]
 
     # Define models
     cnn_encoder = (
         CNNEncoder(
             keys=cnn_keys,
-            input_channels=[int(np.prod(obs_space[k].shape[:-2])) for k in cnn_keys],
+            input_channels=cnn_channels,
             image_size=obs_space[cnn_keys[0]].shape[-2:],
             channels_multiplier=args.cnn_channels_multiplier,
             layer_norm=False,
@@ -400,7 +662,9 @@ def build_models(
     )
     encoder = MultiEncoder(cnn_encoder, mlp_encoder)
     recurrent_model = RecurrentModel(
-        input_size=sum(actions_dim) + args.stochastic_size, recurrent_state_size=args.recurrent_state_size
+        # the action dimensions may be numpy integers, which cannot be scripted as constants
+        input_size=int(sum(actions_dim)) + args.stochastic_size,
+        recurrent_state_size=args.recurrent_state_size,
     )
     representation_model = MLP(
         input_dims=args.recurrent_state_size + encoder.cnn_output_dim + encoder.mlp_output_dim,
@@ -416,16 +680,11 @@ def build_models(
         activation=dense_act,
         flatten_dim=None,
     )
-    rssm = RSSM(
-        recurrent_model.apply(init_weights),
-        representation_model.apply(init_weights),
-        transition_model.apply(init_weights),
-        args.min_std,
-    )
+    rssm = RSSM(recurrent_model, representation_model, transition_model, args.min_std)
     cnn_decoder = (
         CNNDecoder(
             keys=cnn_keys,
-            output_channels=[int(np.prod(obs_space[k].shape[:-2])) for k in cnn_keys],
+            output_channels=cnn_channels,
             channels_multiplier=args.cnn_channels_multiplier,
             latent_state_size=latent_state_size,
             cnn_encoder_output_dim=cnn_encoder.output_dim,
@@ -466,11 +725,11 @@ def build_models(
             flatten_dim=None,
         )
     world_model = WorldModel(
-        encoder.apply(init_weights),
+        encoder,
         rssm,
-        observation_model.apply(init_weights),
-        reward_model.apply(init_weights),
-        continue_model.apply(init_weights) if args.use_continues else None,
+        observation_model,
+        reward_model,
+        continue_model if args.use_continues else None,
     )
     if "minedojo" in args.env_id:
         actor = MinedojoActor(
@@ -505,6 +764,8 @@ def build_models(
         activation=dense_act,
         flatten_dim=None,
     )
+    # Initialize all the models with a single traversal of each module tree
+    world_model.apply(init_weights)
     actor.apply(init_weights)
     critic.apply(init_weights)
 
@@ -516,16 +777,48 @@ def build_models(
     if critic_state:
         critic.load_state_dict(critic_state)
 
+    # Store the convolutional weights in the NHWC layout, so that cuDNN selects the channels-last kernels:
+    # the inputs do not need to be converted since the 4D weights determine the layout of the convolutions
+    if args.cnn_channels_last:
+        world_model.encoder.to(memory_format=torch.channels_last)
+        world_model.observation_model.to(memory_format=torch.channels_last)
+
     # Setup models with Fabric
     world_model.encoder = fabric.setup_module(world_model.encoder)
     world_model.observation_model = fabric.setup_module(world_model.observation_model)
     world_model.reward_model = fabric.setup_module(world_model.reward_model)
     world_model.rssm.recurrent_model = fabric.setup_module(world_model.rssm.recurrent_model)
+    # The weights of the GRU must be compacted again after they have been moved to the device
+    world_model.rssm.recurrent_model.module.rnn.flatten_parameters()
     world_model.rssm.representation_model = fabric.setup_module(world_model.rssm.representation_model)
     world_model.rssm.transition_model = fabric.setup_module(world_model.rssm.transition_model)
-    if world_model.continue_model:
+    if world_model.continue_model is not None:
         world_model.continue_model = fabric.setup_module(world_model.continue_model)
     actor = fabric.setup_module(actor)
     critic = fabric.setup_module(critic)
 
+    # Warm up the deterministic models on the shapes used to act and to learn,
+    # so that the GPU libraries are initialized before the first environment step
+    if fabric.device.type == "cuda":
+        embedded_obs_size = world_model.encoder.module.output_dim
+        with torch.no_grad():
+            for batch_size in (args.num_envs, args.per_rank_batch_size):
+                recurrent_state = torch.zeros(1, batch_size, args.recurrent_state_size, device=fabric.device)
+                world_model.rssm.recurrent_model(
+                    torch.zeros(1, batch_size, sum(actions_dim) + args.stochastic_size, device=fabric.device),
+                    recurrent_state,
+                )
+                world_model.rssm.representation_model(
+                    torch.zeros(1, batch_size, args.recurrent_state_size + embedded_obs_size, device=fabric.device)
+                )
+                world_model.rssm.transition_model(recurrent_state)
+            latent_states = torch.zeros(
+                args.horizon,
+                args.per_rank_batch_size * args.per_rank_sequence_length,
+                latent_state_size,
+                device=fabric.device,
+            )
+            world_model.reward_model(latent_states)
+            critic(latent_states)
+
     return world_model, actor, critic
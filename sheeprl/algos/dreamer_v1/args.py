@@ -20,6 +20,21 @@ class DreamerV1Args(StandardArgs):
     gradient_steps: int = Arg(default=100, help="the number of gradient steps per each environment interaction")
     train_every: int = Arg(default=1000, help="the number of steps between one training and another")
     checkpoint_buffer: bool = Arg(default=False, help="whether or not to save the buffer during the checkpoint")
+    jit_inference: bool = Arg(
+        default=False,
+        help="whether or not to compile with TorchScript the models used by the player to act "
+        "(the TorchScript executor is changed only while the player acts)",
+    )
+    cuda_graph_inference: bool = Arg(
+        default=False, help="whether or not to capture in a CUDA graph the computation of the actions of the player"
+    )
+    bf16_inference: bool = Arg(
+        default=False, help="whether or not to compute the actions of the player in bfloat16 mixed precision"
+    )
+    float32_matmul_precision: str = Arg(
+        default="highest",
+        help="the precision of the float32 matrix multiplications, one of 'highest', 'high' (TF32) or 'medium'",
+    )
 
     # Agent settings
     world_lr: float = Arg(default=6e-4, help="the learning rate of the optimizer of the world model")
@@ -50,6 +65,9 @@ class DreamerV1Args(StandardArgs):
         help="the number of MLP layers for every model: actor, critic, reward and possibly the continue model",
     )
     cnn_channels_multiplier: int = Arg(default=32, help="cnn width multiplication factor, must be greater than zero")
+    cnn_channels_last: bool = Arg(
+        default=False, help="whether or not to use the channels-last memory format for the convolutional layers"
+    )
     dense_act: str = Arg(
         default="ELU",
         help="the activation function for the dense layers, "
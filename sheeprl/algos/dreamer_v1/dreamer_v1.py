@@ -138,27 +138,24 @@ def train(
     posteriors_mean = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
     posteriors_std = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
 
-    # priors_mean and priors_std will contain all
-    # the predicted means and stds of the prior states respectively,
-    # their dimension is (sequence_length, batch_size, stochastic_size)
-    priors_mean = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
-    priors_std = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
-
     embedded_obs = world_model.encoder(batch_obs)
 
     for i in range(0, sequence_length):
         # one step of dynamic learning, take the posterior state, the recurrent state, the action, and the observation
-        # compute the mean and std of both the posterior and prior state, the new recurrent state
+        # compute the mean and std of the posterior state, the new recurrent state
         # and the new posterior state
-        recurrent_state, posterior, _, posterior_mean_std, prior_state_mean_std = world_model.rssm.dynamic(
+        recurrent_state, posterior, posterior_mean_std = world_model.rssm.dynamic_posterior(
             posterior, recurrent_state, data["actions"][i : i + 1], embedded_obs[i : i + 1]
         )
         recurrent_states[i] = recurrent_state
         posteriors[i] = posterior
         posteriors_mean[i] = posterior_mean_std[0]
         posteriors_std[i] = posterior_mean_std[1]
-        priors_mean[i] = prior_state_mean_std[0]
-        priors_std[i] = prior_state_mean_std[1]
+
+    # the prior states depend only on the recurrent states, so the predicted means and stds
+    # of all the prior states are computed at once by the transition model,
+    # their dimension is (sequence_length, batch_size, stochastic_size)
+    (priors_mean, priors_std), _ = world_model.rssm._transition(recurrent_states)
 
     # concatenate the posterior states with the recurrent states on the last dimension
     # latent_states tensor has dimension (sequence_length, batch_size, recurrent_state_size + stochastic_size)
@@ -179,7 +176,7 @@ def train(
     qr = Independent(Normal(world_model.reward_model(latent_states), 1), 1)
 
     # compute predictions for terminal steps, if required
-    if args.use_continues and world_model.continue_model:
+    if args.use_continues and world_model.continue_model is not None:
         qc = Independent(Bernoulli(logits=world_model.continue_model(latent_states), validate_args=False), 1)
         continue_targets = (1 - data["dones"]) * args.gamma
     else:
@@ -236,26 +233,9 @@ def train(
     # during the dynamic learning phase, its shape is (1, batch_size * sequence_length, recurrent_state_size).
     recurrent_state = recurrent_states.detach().reshape(1, -1, args.recurrent_state_size)
 
-    # starting states for the imagination phase.
-    # (1, batch_size * sequence_length, determinisitic_size + stochastic_size)
-    imagined_latent_states = torch.cat((imagined_prior, recurrent_state), -1)
-
-    # initialize the tensor of the imagined states
-    imagined_trajectories = torch.empty(
-        args.horizon, batch_size * sequence_length, args.stochastic_size + args.recurrent_state_size, device=device
-    )
-
-    # imagine trajectories in the latent space
-    for i in range(args.horizon):
-        # actions tensor has dimension (1, batch_size * sequence_length, num_actions)
-        actions = torch.cat(actor(imagined_latent_states.detach())[0], dim=-1)
-
-        # imagination step
-        imagined_prior, recurrent_state = world_model.rssm.imagination(imagined_prior, recurrent_state, actions)
-
-        # update current state
-        imagined_latent_states = torch.cat((imagined_prior, recurrent_state), -1)
-        imagined_trajectories[i] = imagined_latent_states
+    # imagine trajectories in the latent space, the imagined trajectories have dimension
+    # (horizon, batch_size * sequence_length, determinisitic_size + stochastic_size)
+    imagined_trajectories = world_model.rssm.imagine_trajectory(imagined_prior, recurrent_state, actor, args.horizon)
 
     # predict values and rewards
     # it is necessary an Independent distribution because
@@ -265,7 +245,7 @@ def train(
     predicted_rewards = Independent(Normal(world_model.reward_model(imagined_trajectories), 1), 1).mean
 
     # predict the probability that the episode will continue in the imagined states
-    if args.use_continues and world_model.continue_model:
+    if args.use_continues and world_model.continue_model is not None:
         predicted_continues = Independent(Bernoulli(logits=world_model.continue_model(imagined_trajectories)), 1).mean
     else:
         predicted_continues = torch.ones_like(predicted_rewards.detach()) * args.gamma
@@ -372,6 +352,7 @@ def main():
     device = fabric.device
     fabric.seed_everything(args.seed)
     torch.backends.cudnn.deterministic = args.torch_deterministic
+    torch.set_float32_matmul_precision(args.float32_matmul_precision)
 
     if args.checkpoint_path:
         state = fabric.load(args.checkpoint_path)
@@ -469,6 +450,9 @@ def main():
         args.stochastic_size,
         args.recurrent_state_size,
         fabric.device,
+        jit_inference=args.jit_inference,
+        cuda_graph=args.cuda_graph_inference,
+        bf16=args.bf16_inference,
     )
 
     # Optimizers
@@ -3,9 +3,9 @@ from typing import Tuple
 import torch
 import torch.nn.functional as F
 from torch import Tensor
-from torch.distributions import Distribution, Independent, Normal
 
 
+@torch.jit.script
 def compute_stochastic_state(
     state_information: Tensor,
     event_shape: int = 1,
@@ -18,6 +18,7 @@ def compute_stochastic_state(
         state_information (Tensor): information about the distribution of the stochastic state,
             it is the output of either the representation model or the transition model.
         event_shape (int): how many batch dimensions have to be reinterpreted as event dims.
+            It does not change the sampled state, it is kept for compatibility.
             Default to 1.
         min_std (float): the minimum value for the standard deviation.
             Default to 0.1.
@@ -28,11 +29,7 @@ def compute_stochastic_state(
     """
     mean, std = torch.chunk(state_information, 2, -1)
     std = F.softplus(std) + min_std
-    state_distribution: Distribution = Normal(mean, std)
-    if event_shape:
-        # it is necessary an Independent distribution because
-        # it is necessary to create (batch_size * sequence_length) independent distributions,
-        # each producing a sample of size equal to the stochastic size
-        state_distribution = Independent(state_distribution, event_shape)
-    stochastic_state = state_distribution.rsample()
+    # reparameterized sample of the Normal distribution: since its dimensions are independent, the sample is
+    # the same with or without the reinterpretation of the last `event_shape` batch dimensions as event dimensions
+    stochastic_state = mean + std * torch.randn_like(mean)
     return (mean, std), stochastic_state
@@ -358,6 +358,35 @@ class RSSM(nn.Module):
         posterior_logits, posterior = self._representation(recurrent_state, embedded_obs)
         return recurrent_state, posterior, prior, posterior_logits, prior_logits
 
+    def dynamic_posterior(
+        self, posterior: Tensor, recurrent_state: Tensor, action: Tensor, embedded_obs: Tensor, is_first: Tensor
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Perform one step of the dynamic learning without the transition model.
+        Since the prior depends only on the recurrent state, the priors of a whole sequence
+        can be computed with a single call to the transition model on the stacked recurrent states.
+
+        Args:
+            posterior (Tensor): the stochastic state computed by the representation model (posterior). It is expected
+                to be of dimension `[stoch_size, self.discrete]`, which by default is `[32, 32]`.
+            recurrent_state (Tensor): a tuple representing the recurrent state of the recurrent model.
+            action (Tensor): the action taken by the agent.
+            embedded_obs (Tensor): the embedded observations provided by the environment.
+            is_first (Tensor): if this is the first step in the episode.
+
+        Returns:
+            The recurrent state (Tensor): the recurrent state of the recurrent model.
+            The posterior stochastic state (Tensor): computed by the representation model
+            The logits of the posterior state (Tensor): computed by the representation model
+            from the recurrent state and the embbedded observation.
+        """
+        action = (1 - is_first) * action
+        posterior = (1 - is_first) * posterior.view(*posterior.shape[:-2], -1)
+        recurrent_state = (1 - is_first) * recurrent_state
+        recurrent_state = self.recurrent_model(torch.cat((posterior, action), -1), recurrent_state)
+        posterior_logits, posterior = self._representation(recurrent_state, embedded_obs)
+        return recurrent_state, posterior, posterior_logits
+
     def _representation(self, recurrent_state: Tensor, embedded_obs: Tensor) -> Tuple[Tensor, Tensor]:
         """
         Args:
@@ -370,7 +399,8 @@ class RSSM(nn.Module):
             logits (Tensor): the logits of the distribution of the posterior state.
             posterior (Tensor): the sampled posterior stochastic state.
         """
-        logits = self.representation_model(torch.cat((recurrent_state, embedded_obs), -1))
+        # the stochastic state is always sampled from float32 logits, also under mixed precision
+        logits = self.representation_model(torch.cat((recurrent_state, embedded_obs), -1)).float()
         return logits, compute_stochastic_state(logits, discrete=self.discrete)
 
     def _transition(self, recurrent_out: Tensor) -> Tuple[Tensor, Tensor]:
@@ -382,7 +412,7 @@ class RSSM(nn.Module):
             logits (Tensor): the logits of the distribution of the prior state.
             prior (Tensor): the sampled prior stochastic state.
         """
-        logits = self.transition_model(recurrent_out)
+        logits = self.transition_model(recurrent_out).float()
         return logits, compute_stochastic_state(logits, discrete=self.discrete)
 
     def imagination(self, prior: Tensor, recurrent_state: Tensor, actions: Tensor) -> Tuple[Tensor, Tensor]:
@@ -403,6 +433,50 @@ class RSSM(nn.Module):
         _, imagined_prior = self._transition(recurrent_state)
         return imagined_prior, recurrent_state
 
+    def imagine_trajectory(
+        self,
+        prior: Tensor,
+        recurrent_state: Tensor,
+        actor: nn.Module,
+        imagined_trajectories: Tensor,
+        imagined_actions: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        """
+        Imagine the trajectories in the latent space following the actions selected by the actor.
+        The imagined latent states and actions are written into the given tensors from the index 1 on,
+        the index 0 is reserved to the starting latent states and actions.
+        The horizon is given by the first dimension of the tensors minus one.
+
+        Args:
+            prior (Tensor): the starting stochastic states.
+                Shape (1, batch_size, stochastic_size * discrete_size).
+            recurrent_state (Tensor): the starting recurrent states.
+                Shape (1, batch_size, recurrent_state_size).
+            actor (nn.Module): the actor that selects the actions from the latent states.
+            imagined_trajectories (Tensor): where to write the imagined latent states.
+                Shape (horizon + 1, batch_size, stochastic_size * discrete_size + recurrent_state_size).
+            imagined_actions (Tensor): where to write the imagined actions.
+                Shape (horizon + 1, batch_size, sum(actions_dim)).
+
+        Returns:
+            The imagined trajectories (Tensor) and the imagined actions (Tensor).
+        """
+        stoch_state_size = prior.shape[-1]
+        imagined_latent_state = torch.cat((prior, recurrent_state), -1)
+        for i in range(1, imagined_trajectories.shape[0]):
+            # (1, batch_size, sum(actions_dim))
+            actions = torch.cat(actor(imagined_latent_state.detach())[0], dim=-1)
+            imagined_actions[i] = actions
+
+            # Imagination step
+            prior, recurrent_state = self.imagination(prior, recurrent_state, actions)
+
+            # Update current state
+            prior = prior.view(1, -1, stoch_state_size)
+            imagined_latent_state = torch.cat((prior, recurrent_state), -1)
+            imagined_trajectories[i] = imagined_latent_state
+        return imagined_trajectories, imagined_actions
+
 
 class Actor(nn.Module):
     """
@@ -495,7 +569,8 @@ class Actor(nn.Module):
             The distribution of the actions
         """
         out: Tensor = self.model(state)
-        pre_dist: List[Tensor] = [head(out) for head in self.mlp_heads]
+        # the distributions are always built in float32, also under mixed precision
+        pre_dist: List[Tensor] = [head(out).float() for head in self.mlp_heads]
         if self.is_continuous:
             mean, std = torch.chunk(pre_dist[0], 2, -1)
             if self.distribution == "tanh_normal":
@@ -576,7 +651,7 @@ class MinedojoActor(Actor):
             The distribution of the actions
         """
         out: Tensor = self.model(state)
-        actions_logits: List[Tensor] = [head(out) for head in self.mlp_heads]
+        actions_logits: List[Tensor] = [head(out).float() for head in self.mlp_heads]
         actions_dist: List[Distribution] = []
         actions: List[Tensor] = []
         functional_action = None
@@ -992,6 +1067,12 @@ def build_models(
     if critic_state:
         critic.load_state_dict(critic_state)
 
+    # Store the convolutional weights in the NHWC layout, so that cuDNN selects the channels-last kernels:
+    # the inputs do not need to be converted since the 4D weights determine the layout of the convolutions
+    if args.cnn_channels_last:
+        world_model.encoder.to(memory_format=torch.channels_last)
+        world_model.observation_model.to(memory_format=torch.channels_last)
+
     # Setup models with Fabric
     world_model.encoder = fabric.setup_module(world_model.encoder)
     world_model.observation_model = fabric.setup_module(world_model.observation_model)
@@ -1006,5 +1087,8 @@ def build_models(
     target_critic = copy.deepcopy(critic.module)
     if target_critic_state:
         target_critic.load_state_dict(target_critic_state)
+    # The target critic is only updated by copying the critic weights: the gradients
+    # are needed for its inputs (the imagined trajectories), not for its parameters
+    target_critic.requires_grad_(False)
 
     return world_model, actor, critic, target_critic
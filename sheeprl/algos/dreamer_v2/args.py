@@ -23,12 +23,32 @@ class DreamerV2Args(StandardArgs):
     gradient_steps: int = Arg(default=1, help="the number of gradient steps per each environment interaction")
     train_every: int = Arg(default=5, help="the number of steps between one training and another")
     checkpoint_buffer: bool = Arg(default=False, help="whether or not to save the buffer during the checkpoint")
+    async_checkpoint: bool = Arg(
+        default=False,
+        help="whether to write the checkpoints in a background thread (the buffer is always saved synchronously)",
+    )
+    device_buffer: bool = Arg(
+        default=False,
+        help="whether to keep the replay buffer on the training device, "
+        "so that the sampled batches do not have to be copied to it at every training step",
+    )
     buffer_type: str = Arg(
         default="sequential",
         help="which buffer to use: `sequential` or `episode`. The `episode` "
         "buffer will save an entire episode, while the sequential will save every step.",
     )
     prioritize_ends: bool = Arg(default=False, help="whether to sample episodes prioritizing the end of them.")
+    bf16_training: bool = Arg(
+        default=False,
+        help="whether to compute the forward passes of the models during training in bfloat16 mixed precision",
+    )
+    compile_train: bool = Arg(
+        default=False, help="whether to compile the training step with `torch.compile` (requires PyTorch 2.0)"
+    )
+    compile_train_mode: str = Arg(
+        default="default",
+        help="the `torch.compile` mode of the training step, one of 'default' or 'max-autotune'",
+    )
 
     # Agent settings
     world_lr: float = Arg(default=3e-4, help="the learning rate of the optimizer of the world model")
@@ -64,6 +84,9 @@ class DreamerV2Args(StandardArgs):
         default=4, help="the number of MLP layers for every model: actor, critic, continue and reward"
     )
     cnn_channels_multiplier: int = Arg(default=48, help="cnn width multiplication factor, must be greater than zero")
+    cnn_channels_last: bool = Arg(
+        default=False, help="whether or not to use the channels-last memory format for the convolutional layers"
+    )
     dense_act: str = Arg(
         default="ELU",
         help="the activation function for the dense layers, "
@@ -2,17 +2,16 @@
 Adapted from the original implementation from https://github.com/danijar/dreamerv2
 """
 
-import copy
 import os
 import pathlib
 import time
 from dataclasses import asdict
-from typing import Dict, Sequence
+from functools import partial
+from typing import Dict, Optional, Sequence
 
 import gymnasium as gym
 import numpy as np
 import torch
-import torch.nn.functional as F
 from lightning.fabric import Fabric
 from lightning.fabric.fabric import _is_using_cli
 from lightning.fabric.wrappers import _FabricModule
@@ -21,13 +20,12 @@ from tensordict.tensordict import TensorDictBase
 from torch import Tensor
 from torch.distributions import Bernoulli, Distribution, Independent, Normal, OneHotCategorical
 from torch.optim import Adam, Optimizer
-from torch.utils.data import BatchSampler
 from torchmetrics import MeanMetric
 
 from sheeprl.algos.dreamer_v2.agent import PlayerDV2, WorldModel, build_models
 from sheeprl.algos.dreamer_v2.args import DreamerV2Args
 from sheeprl.algos.dreamer_v2.loss import reconstruction_loss
-from sheeprl.algos.dreamer_v2.utils import compute_lambda_values, test
+from sheeprl.algos.dreamer_v2.utils import compute_lambda_values, copy_params, get_scratch_buffer, normalize_image, test
 from sheeprl.data.buffers import AsyncReplayBuffer, EpisodeBuffer
 from sheeprl.utils.callback import CheckpointCallback
 from sheeprl.utils.env import make_dict_env
@@ -35,7 +33,7 @@ from sheeprl.utils.logger import create_tensorboard_logger
 from sheeprl.utils.metric import MetricAggregator
 from sheeprl.utils.parser import HfArgumentParser
 from sheeprl.utils.registry import register_algorithm
-from sheeprl.utils.utils import polynomial_decay
+from sheeprl.utils.utils import compile_train_fn, polynomial_decay
 
 # Decomment the following two lines if you cannot start an experiment with DMC environments
 # os.environ["PYOPENGL_PLATFORM"] = ""
@@ -57,6 +55,7 @@ def train(
     cnn_keys: Sequence[str],
     mlp_keys: Sequence[str],
     actions_dim: Sequence[int],
+    scratch_buffers: Optional[Dict[str, Tensor]] = None,
 ) -> None:
     """Runs one-step update of the agent.
 
@@ -107,6 +106,9 @@ def train(
         cnn_keys (Sequence[str]): the cnn keys to encode/decode.
         mlp_keys (Sequence[str]): the mlp keys to encode/decode.
         actions_dim (Sequence[int]): the actions dimension.
+        scratch_buffers (Dict[str, Tensor], optional): the buffers reused across the training steps
+            for the intermediate states. If None, they are allocated at every call.
+            Default to None.
     """
 
     # The environment interaction goes like this:
@@ -122,60 +124,90 @@ def train(
     batch_size = args.per_rank_batch_size
     sequence_length = args.per_rank_sequence_length
     device = fabric.device
-    batch_obs = {k: data[k] / 255 - 0.5 for k in cnn_keys}
+    batch_obs = {k: normalize_image(data[k]) for k in cnn_keys}
     batch_obs.update({k: data[k] for k in mlp_keys})
 
     # Given how the environment interaction works, we assume that the first element in a sequence
     # is the first one, as if the environment has been reset
-    data["is_first"][0, :] = torch.tensor([1.0], device=fabric.device).expand_as(data["is_first"][0, :])
+    data["is_first"][0, :] = 1.0
 
     # Dynamic Learning
     stoch_state_size = args.stochastic_size * args.discrete_size
-    recurrent_state = torch.zeros(1, batch_size, args.recurrent_state_size, device=device)
-    posterior = torch.zeros(1, batch_size, args.stochastic_size, args.discrete_size, device=device)
+    recurrent_state = get_scratch_buffer(
+        scratch_buffers, "recurrent_state", (1, batch_size, args.recurrent_state_size), device, zero=True
+    )
+    posterior = get_scratch_buffer(
+        scratch_buffers, "posterior", (1, batch_size, args.stochastic_size, args.discrete_size), device, zero=True
+    )
 
     # Initialize the recurrent_states, which will contain all the recurrent states
-    # computed during the dynamic learning phase
-    recurrent_states = torch.zeros(sequence_length, batch_size, args.recurrent_state_size, device=device)
-
-    # Initialize all the tensor to collect priors and posteriors states with their associated logits
-    priors_logits = torch.empty(sequence_length, batch_size, stoch_state_size, device=device)
-    posteriors = torch.empty(sequence_length, batch_size, args.stochastic_size, args.discrete_size, device=device)
-    posteriors_logits = torch.empty(sequence_length, batch_size, stoch_state_size, device=device)
-
-    # Embed observations from the environment
-    embedded_obs = world_model.encoder(batch_obs)
-
-    for i in range(0, sequence_length):
-        # One step of dynamic learning, which take the posterior state, the recurrent state, the action
-        # and the observation and compute the next recurrent, prior and posterior states
-        recurrent_state, posterior, _, posterior_logits, prior_logits = world_model.rssm.dynamic(
-            posterior, recurrent_state, data["actions"][i : i + 1], embedded_obs[i : i + 1], data["is_first"][i : i + 1]
-        )
-        recurrent_states[i] = recurrent_state
-        priors_logits[i] = prior_logits
-        posteriors[i] = posterior
-        posteriors_logits[i] = posterior_logits
-
-    # Concatenate the posteriors with the recurrent states on the last dimension.
-    # Latent_states has dimension (sequence_length, batch_size, recurrent_state_size + stochastic_size * discrete_size)
-    latent_states = torch.cat((posteriors.view(*posteriors.shape[:-2], -1), recurrent_states), -1)
-
-    # Compute predictions for the observations
-    decoded_information: Dict[str, torch.Tensor] = world_model.observation_model(latent_states)
-
-    # Compute the distribution over the reconstructed observations
-    po = {k: Independent(Normal(rec_obs, 1), len(rec_obs.shape[2:])) for k, rec_obs in decoded_information.items()}
+    # computed during the dynamic learning phase (they are all overwritten, so they are not zeroed)
+    recurrent_states = get_scratch_buffer(
+        scratch_buffers, "recurrent_states", (sequence_length, batch_size, args.recurrent_state_size), device
+    )
 
-    # Compute the distribution over the rewards
-    pr = Independent(Normal(world_model.reward_model(latent_states), 1), 1)
+    # Initialize all the tensor to collect posteriors states with their associated logits
+    posteriors = get_scratch_buffer(
+        scratch_buffers,
+        "posteriors",
+        (sequence_length, batch_size, args.stochastic_size, args.discrete_size),
+        device,
+    )
+    posteriors_logits = get_scratch_buffer(
+        scratch_buffers, "posteriors_logits", (sequence_length, batch_size, stoch_state_size), device
+    )
 
-    # Compute the distribution over the terminal steps, if required
-    if args.use_continues and world_model.continue_model:
-        pc = Independent(Bernoulli(logits=world_model.continue_model(latent_states), validate_args=False), 1)
-        continue_targets = (1 - data["dones"]) * args.gamma
-    else:
-        pc = continue_targets = None
+    # The forward passes can be computed in bfloat16 mixed precision, while the distributions
+    # are always built on float32 tensors
+    autocast = partial(torch.autocast, device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16_training)
+
+    with autocast():
+        # Embed observations from the environment
+        embedded_obs = world_model.encoder(batch_obs)
+
+        for i in range(0, sequence_length):
+            # One step of dynamic learning, which take the posterior state, the recurrent state, the action
+            # and the observation and compute the next recurrent and posterior states
+            recurrent_state, posterior, posterior_logits = world_model.rssm.dynamic_posterior(
+                posterior,
+                recurrent_state,
+                data["actions"][i : i + 1],
+                embedded_obs[i : i + 1],
+                data["is_first"][i : i + 1],
+            )
+            recurrent_states[i] = recurrent_state
+            posteriors[i] = posterior
+            posteriors_logits[i] = posterior_logits
+
+        # The priors depend only on the recurrent states, so their logits are computed
+        # all at once by the transition model, with shape (sequence_length, batch_size, stoch_state_size)
+        priors_logits = world_model.rssm.transition_model(recurrent_states).float()
+
+        # Concatenate the posteriors with the recurrent states on the last dimension.
+        # Latent_states has dimension
+        # (sequence_length, batch_size, recurrent_state_size + stochastic_size * discrete_size)
+        latent_states = torch.cat((posteriors.view(*posteriors.shape[:-2], -1), recurrent_states), -1)
+
+        # Compute predictions for the observations
+        decoded_information: Dict[str, torch.Tensor] = world_model.observation_model(latent_states)
+
+        # Compute the distribution over the reconstructed observations
+        po = {
+            k: Independent(Normal(rec_obs.float(), 1), len(rec_obs.shape[2:]))
+            for k, rec_obs in decoded_information.items()
+        }
+
+        # Compute the distribution over the rewards
+        pr = Independent(Normal(world_model.reward_model(latent_states).float(), 1), 1)
+
+        # Compute the distribution over the terminal steps, if required
+        if args.use_continues and world_model.continue_model:
+            pc = Independent(
+                Bernoulli(logits=world_model.continue_model(latent_states).float(), validate_args=False), 1
+            )
+            continue_targets = (1 - data["dones"]) * args.gamma
+        else:
+            pc = continue_targets = None
 
     # Reshape posterior and prior logits to shape [T, B, 32, 32]
     priors_logits = priors_logits.view(*priors_logits.shape[:-1], args.stochastic_size, args.discrete_size)
@@ -203,8 +235,8 @@ def train(
         world_model_grads = fabric.clip_gradients(
             module=world_model, optimizer=world_optimizer, max_norm=args.clip_gradients, error_if_nonfinite=False
         )
+        aggregator.update("Grads/world_model", world_model_grads.detach())
     world_optimizer.step()
-    aggregator.update("Grads/world_model", world_model_grads.mean().detach())
     aggregator.update("Loss/reconstruction_loss", rec_loss.detach())
     aggregator.update("Loss/observation_loss", observation_loss.detach())
     aggregator.update("Loss/reward_loss", reward_loss.detach())
@@ -231,22 +263,22 @@ def train(
     imagined_latent_state = torch.cat((imagined_prior, recurrent_state), -1)
 
     # Initialize the tensor of the imagined trajectories
-    imagined_trajectories = torch.empty(
-        args.horizon + 1,
-        batch_size * sequence_length,
-        stoch_state_size + args.recurrent_state_size,
-        device=device,
+    imagined_trajectories = get_scratch_buffer(
+        scratch_buffers,
+        "imagined_trajectories",
+        (args.horizon + 1, batch_size * sequence_length, stoch_state_size + args.recurrent_state_size),
+        device,
     )
     imagined_trajectories[0] = imagined_latent_state
 
     # Initialize the tensor of the imagined actions
-    imagined_actions = torch.empty(
-        args.horizon + 1,
-        batch_size * sequence_length,
-        data["actions"].shape[-1],
-        device=device,
+    imagined_actions = get_scratch_buffer(
+        scratch_buffers,
+        "imagined_actions",
+        (args.horizon + 1, batch_size * sequence_length, data["actions"].shape[-1]),
+        device,
     )
-    imagined_actions[0] = torch.zeros(1, batch_size * sequence_length, data["actions"].shape[-1])
+    imagined_actions[0].zero_()
 
     # The imagination goes like this, with H=3:
     # Actions:       0   a'1      a'2     a'3
@@ -261,31 +293,24 @@ def train(
     # where z0 comes from the posterior (is initialized as the concatenation of the posteriors and the recurrent states)
     # while z'i is the imagined states (prior)
 
-    # Imagine trajectories in the latent space
-    for i in range(1, args.horizon + 1):
-        # (1, batch_size * sequence_length, sum(actions_dim))
-        actions = torch.cat(actor(imagined_latent_state.detach())[0], dim=-1)
-        imagined_actions[i] = actions
-
-        # Imagination step
-        imagined_prior, recurrent_state = world_model.rssm.imagination(imagined_prior, recurrent_state, actions)
-
-        # Update current state
-        imagined_prior = imagined_prior.view(1, -1, stoch_state_size)
-        imagined_latent_state = torch.cat((imagined_prior, recurrent_state), -1)
-        imagined_trajectories[i] = imagined_latent_state
-
-    # Predict values and rewards
-    predicted_target_values = Independent(Normal(target_critic(imagined_trajectories), 1), 1).mode
-    predicted_rewards = Independent(Normal(world_model.reward_model(imagined_trajectories), 1), 1).mode
-    if args.use_continues and world_model.continue_model:
-        continues = Independent(
-            Bernoulli(logits=world_model.continue_model(imagined_trajectories), validate_args=False), 1
-        ).mean
-        true_done = (1 - data["dones"]).reshape(1, -1, 1) * args.gamma
-        continues = torch.cat((true_done, continues[1:]))
-    else:
-        continues = torch.ones_like(predicted_rewards.detach()) * args.gamma
+    with autocast():
+        # Imagine trajectories in the latent space
+        imagined_trajectories, imagined_actions = world_model.rssm.imagine_trajectory(
+            imagined_prior, recurrent_state, actor, imagined_trajectories, imagined_actions
+        )
+
+        # Predict values and rewards: the modes of the unit-variance Normal distributions are their means,
+        # while the mean of the Bernoulli distribution of the continues is the sigmoid of its logits
+        predicted_target_values = target_critic(imagined_trajectories).float()
+        predicted_rewards = world_model.reward_model(imagined_trajectories).float()
+        if args.use_continues and world_model.continue_model:
+            # The first continues are the real ones, so the continue model is evaluated only on the imagined states
+            true_done = (1 - data["dones"]).reshape(1, -1, 1) * args.gamma
+            continues = torch.cat(
+                (true_done, torch.sigmoid(world_model.continue_model(imagined_trajectories[1:]).float()))
+            )
+        else:
+            continues = predicted_rewards.new_full(predicted_rewards.shape, args.gamma)
 
     # Compute the lambda_values, by passing as last value the value of the last imagined state
     # (horizon, batch_size * sequence_length, 1)
@@ -299,8 +324,11 @@ def train(
     )
 
     # Compute the discounts to multiply the lambda values
+    # (discount[0] = 1, discount[t] = continues[0] * ... * continues[t-1])
     with torch.no_grad():
-        discount = torch.cumprod(torch.cat((torch.ones_like(continues[:1]), continues[:-1]), 0), 0)
+        discount = torch.empty_like(continues)
+        discount[0] = 1
+        torch.cumprod(continues[:-1], 0, out=discount[1:])
 
     # Actor optimization step. Eq. 6 from the paper
     # Given the following diagram, with H=3:
@@ -319,26 +347,27 @@ def train(
     #  anywhere anymore. One target is lost at the start of the trajectory
     #  because the initial state comes from the replay buffer.`
     actor_optimizer.zero_grad(set_to_none=True)
-    policies: Sequence[Distribution] = actor(imagined_trajectories[:-2].detach())[1]
+    with autocast():
+        policies: Sequence[Distribution] = actor(imagined_trajectories[:-2].detach())[1]
 
     # Dynamics backpropagation
     dynamics = lambda_values[1:]
 
     # Reinforce
+    # The log-probabilities and the entropies of the action components are accumulated
+    # without stacking them, so nothing is added when there is only one component
     advantage = (lambda_values[1:] - predicted_target_values[:-2]).detach()
-    reinforce = (
-        torch.stack(
-            [
-                p.log_prob(imgnd_act[1:-1].detach()).unsqueeze(-1)
-                for p, imgnd_act in zip(policies, torch.split(imagined_actions, actions_dim, -1))
-            ],
-            -1,
-        ).sum(-1)
-        * advantage
-    )
+    split_actions = torch.split(imagined_actions[1:-1].detach(), actions_dim, -1)
+    log_prob = policies[0].log_prob(split_actions[0])
+    for p, imgnd_act in zip(policies[1:], split_actions[1:]):
+        log_prob = log_prob + p.log_prob(imgnd_act)
+    reinforce = log_prob.unsqueeze(-1) * advantage
     objective = args.objective_mix * reinforce + (1 - args.objective_mix) * dynamics
     try:
-        entropy = args.actor_ent_coef * torch.stack([p.entropy() for p in policies], -1).sum(dim=-1)
+        entropy = policies[0].entropy()
+        for p in policies[1:]:
+            entropy = entropy + p.entropy()
+        entropy = args.actor_ent_coef * entropy
     except NotImplementedError:
         entropy = torch.zeros_like(objective)
     policy_loss = -torch.mean(discount[:-2].detach() * (objective + entropy.unsqueeze(-1)))
@@ -347,14 +376,15 @@ def train(
         actor_grads = fabric.clip_gradients(
             module=actor, optimizer=actor_optimizer, max_norm=args.clip_gradients, error_if_nonfinite=False
         )
+        aggregator.update("Grads/actor", actor_grads.detach())
     actor_optimizer.step()
-    aggregator.update("Grads/actor", actor_grads.mean().detach())
     aggregator.update("Loss/policy_loss", policy_loss.detach())
 
     # Predict the values distribution only for the first H (horizon)
     # imagined states (to match the dimension with the lambda values),
     # It removes the last imagined state in the trajectory because it is used for bootstrapping
-    qv = Independent(Normal(critic(imagined_trajectories.detach()[:-1]), 1), 1)
+    with autocast():
+        qv = Independent(Normal(critic(imagined_trajectories.detach()[:-1]).float(), 1), 1)
 
     # Critic optimization step. Eq. 5 from the paper.
     critic_optimizer.zero_grad(set_to_none=True)
@@ -364,8 +394,8 @@ def train(
         critic_grads = fabric.clip_gradients(
             module=critic, optimizer=critic_optimizer, max_norm=args.clip_gradients, error_if_nonfinite=False
         )
+        aggregator.update("Grads/critic", critic_grads.detach())
     critic_optimizer.step()
-    aggregator.update("Grads/critic", critic_grads.mean().detach())
     aggregator.update("Loss/value_loss", value_loss.detach())
 
     # Reset everything
@@ -384,7 +414,7 @@ def main():
     args.frame_stack = -1
 
     # Initialize Fabric
-    fabric = Fabric(callbacks=[CheckpointCallback()])
+    fabric = Fabric(callbacks=[CheckpointCallback(async_save=args.async_checkpoint)])
     if not _is_using_cli():
         fabric.launch()
     rank = fabric.global_rank
@@ -431,7 +461,8 @@ def main():
     actions_dim = (
         action_space.shape if is_continuous else (action_space.nvec.tolist() if is_multidiscrete else [action_space.n])
     )
-    clip_rewards_fn = lambda r: torch.tanh(r) if args.clip_rewards else r
+    # The rewards are clipped in-place on the float32 array where they have been copied
+    clip_rewards_fn = lambda r: np.tanh(r, out=r) if args.clip_rewards else r
     cnn_keys = []
     mlp_keys = []
     if isinstance(observation_space, gym.spaces.Dict):
@@ -525,18 +556,23 @@ def main():
                 "Grads/world_model": MeanMetric(sync_on_compute=False),
                 "Grads/actor": MeanMetric(sync_on_compute=False),
                 "Grads/critic": MeanMetric(sync_on_compute=False),
-            }
+            },
+            lazy_updates=True,
         )
     aggregator.to(fabric.device)
 
     # Local data
     buffer_size = args.buffer_size // int(args.num_envs * fabric.world_size) if not args.dry_run else 2
     buffer_type = args.buffer_type.lower()
+    if args.device_buffer and args.memmap_buffer:
+        raise ValueError("The replay buffer cannot be both memory-mapped and kept on the training device")
+    # The sampled batches are already on the training device if the buffer is kept there
+    buffer_device = device if args.device_buffer else "cpu"
     if buffer_type == "sequential":
         rb = AsyncReplayBuffer(
             buffer_size,
             args.num_envs,
-            device="cpu",
+            device=buffer_device,
             memmap=args.memmap_buffer,
             memmap_dir=os.path.join(log_dir, "memmap_buffer", f"rank_{fabric.global_rank}"),
             sequential=True,
@@ -545,7 +581,7 @@ def main():
         rb = EpisodeBuffer(
             buffer_size,
             sequence_length=args.per_rank_sequence_length,
-            device="cpu",
+            device=buffer_device,
             memmap=args.memmap_buffer,
             memmap_dir=os.path.join(log_dir, "memmap_buffer", f"rank_{fabric.global_rank}"),
         )
@@ -579,8 +615,29 @@ def main():
             max_decay_steps=max_step_expl_decay,
         )
 
+    # The steps of the current episodes (used only by the episode buffer) are written in place into
+    # one tensor per key of shape (episode_capacity, num_envs, *), whose capacity is doubled when needed
+    episode_steps: Dict[str, Tensor] = {}
+    episode_lengths = np.zeros(args.num_envs, dtype=np.int64)
+    episode_capacity = max(args.per_rank_sequence_length, args.max_episode_steps // args.action_repeat + 1)
+
+    def add_episode_steps(data: TensorDictBase, env_idxes: Sequence[int]) -> None:
+        """Append one step, whose batch size is [len(env_idxes)], to the episodes of the given environments."""
+        nonlocal episode_capacity
+        if len(episode_steps) == 0:
+            for k, v in data.items():
+                episode_steps[k] = torch.empty(episode_capacity, args.num_envs, *v.shape[1:], dtype=v.dtype)
+        env_idxes = np.asarray(env_idxes, dtype=np.int64)
+        if episode_lengths[env_idxes].max() >= episode_capacity:
+            for k, v in episode_steps.items():
+                episode_steps[k] = torch.cat((v, torch.empty_like(v)))
+            episode_capacity *= 2
+        steps_idxes = torch.from_numpy(episode_lengths[env_idxes])
+        for k, v in data.items():
+            episode_steps[k][steps_idxes, torch.from_numpy(env_idxes)] = v
+        episode_lengths[env_idxes] += 1
+
     # Get the first environment observation and start the optimization
-    episode_steps = [[] for _ in range(args.num_envs)]
     o = envs.reset(seed=args.seed)[0]
     obs = {}
     for k in o.keys():
@@ -598,31 +655,76 @@ def main():
     if buffer_type == "sequential":
         rb.add(step_data[None, ...])
     else:
-        for i, env_ep in enumerate(episode_steps):
-            env_ep.append(step_data[i : i + 1][None, ...])
+        add_episode_steps(step_data, range(args.num_envs))
     player.init_states()
 
-    gradient_steps = 0
+    # Page-locked staging buffers, so that the observations are copied asynchronously to the GPU:
+    # they can be safely overwritten at every step because the actions are synchronously moved back to the CPU
+    staging_obs = {k: torch.empty_like(v).pin_memory() for k, v in obs.items()} if device.type == "cuda" else None
+
+    # The actions, rewards and dones of every step are written into the same float tensors,
+    # which can be reused because the replay buffer copies the step data when it is added
+    actions_buf = torch.empty(args.num_envs, sum(actions_dim))
+    rewards_buf = torch.empty(args.num_envs, 1)
+    dones_buf = torch.empty(args.num_envs, 1)
+
+    # The (1-D) MLP observations of every step are cast to float32 and packed together by a single
+    # concatenation into the same array: the per-key tensors are views of it, which are overwritten only
+    # after the observations of the previous step have been used and copied into the replay buffer
+    mlp_obs_sizes = [observation_space[k].shape[0] for k in mlp_keys]
+    packed_mlp_obs = np.empty((args.num_envs, sum(mlp_obs_sizes)), dtype=np.float32)
+    packed_mlp_views = dict(zip(mlp_keys, torch.from_numpy(packed_mlp_obs).split(mlp_obs_sizes, dim=-1)))
+
+    # Indices used to one-hot encode the random actions of the environments
+    envs_idxes = np.arange(args.num_envs)[:, None]
+    actions_offsets = np.cumsum([0] + list(actions_dim[:-1]))
+
+    # The constant values of the first step of a new episode, expanded to the number of reset environments
+    reset_zeros = torch.zeros(1, 1)
+    reset_actions = torch.zeros(1, int(np.sum(actions_dim)))
+    reset_is_first = torch.ones(1, 1)
+
+    # The arguments do not change during the training, so they are converted once for all the checkpoints
+    args_dict = asdict(args)
+
+    # The parameters of the critic and of the target critic, used to update the latter
+    critic_params = [p.data for p in critic.module.parameters()]
+    target_critic_params = [p.data for p in target_critic.parameters()]
+
+    # The intermediate tensors of the training steps are allocated once and reused
+    scratch_buffers: Dict[str, Tensor] = {}
+    if args.compile_train:
+        # The training step runs the backward passes, the optimizers and the metric updates, which break
+        # the compiled graphs: the 'reduce-overhead' mode is not allowed, since replaying them in CUDA graphs
+        # together with the gradient clipping and the DDP gradient hooks is not safe.
+        # The fixed batch size, sequence length and horizon let the compiled graphs be reused at every step,
+        # so they are specialized to the static shapes of the batches
+        train_step = compile_train_fn(
+            train, mode=args.compile_train_mode, modes=("default", "max-autotune"), dynamic=False
+        )
+    else:
+        train_step = train
+    # Gradient steps left before the next update of the target critic, which happens at the first one
+    target_update_countdown = 0
     for global_step in range(start_step, num_updates + 1):
         # Sample an action given the observation received by the environment
         if global_step <= learning_starts and args.checkpoint_path is None and "minedojo" not in args.env_id:
             real_actions = actions = np.array(envs.action_space.sample())
             if not is_continuous:
-                actions = np.concatenate(
-                    [
-                        F.one_hot(torch.tensor(act), act_dim).numpy()
-                        for act, act_dim in zip(actions.reshape(len(actions_dim), -1), actions_dim)
-                    ],
-                    axis=-1,
-                )
+                # One-hot encode every action component of every environment at once
+                actions = np.zeros((args.num_envs, sum(actions_dim)), dtype=np.float32)
+                actions[envs_idxes, actions_offsets + real_actions.reshape(args.num_envs, -1)] = 1
         else:
             with torch.no_grad():
                 preprocessed_obs = {}
                 for k, v in obs.items():
+                    if staging_obs is not None:
+                        v = staging_obs[k].copy_(v)
+                    v = v[None, ...].to(device, non_blocking=True)
                     if k in cnn_keys:
-                        preprocessed_obs[k] = v[None, ...].to(device) / 255 - 0.5
+                        preprocessed_obs[k] = normalize_image(v)
                     else:
-                        preprocessed_obs[k] = v[None, ...].to(device)
+                        preprocessed_obs[k] = v
                 mask = {k: v for k, v in preprocessed_obs.items() if k.startswith("mask")}
                 if len(mask) == 0:
                     mask = None
@@ -633,11 +735,12 @@ def main():
                 else:
                     real_actions = np.array([real_act.cpu().argmax(dim=-1).numpy() for real_act in real_actions])
 
-        step_data["is_first"] = copy.deepcopy(step_data["dones"])
+        step_data["is_first"] = step_data["dones"].clone()
         o, rewards, dones, truncated, infos = envs.step(real_actions.reshape(envs.action_space.shape))
         dones = np.logical_or(dones, truncated)
         if args.dry_run and buffer_type == "episode":
             dones = np.ones_like(dones)
+        dones_idxes = np.flatnonzero(dones).tolist()
 
         if "final_info" in infos:
             for i, agent_final_info in enumerate(infos["final_info"]):
@@ -648,59 +751,70 @@ def main():
                     aggregator.update("Rewards/rew_avg", agent_final_info["episode"]["r"][0])
                     aggregator.update("Game/ep_len_avg", agent_final_info["episode"]["l"][0])
 
-        # Save the real next observation
-        real_next_obs = copy.deepcopy(o)
+        # The real next observations of the reset environments must be saved in the step data: since the step data
+        # shares the memory with the next observations, it is copied only in the steps with some reset environments
+        final_obs_idxes = []
         if "final_observation" in infos:
-            for idx, final_obs in enumerate(infos["final_observation"]):
-                if final_obs is not None:
-                    for k, v in final_obs.items():
-                        real_next_obs[k][idx] = v
-
+            final_obs_idxes = [i for i, final_obs in enumerate(infos["final_observation"]) if final_obs is not None]
         next_obs: Dict[str, Tensor] = {}
-        for k in real_next_obs.keys():  # [N_envs, N_obs]
-            if k in obs_keys:
-                next_obs[k] = torch.from_numpy(o[k]).view(args.num_envs, *o[k].shape[1:])
-                step_data[k] = torch.from_numpy(real_next_obs[k]).view(args.num_envs, *real_next_obs[k].shape[1:])
-                if k in mlp_keys:
-                    next_obs[k] = next_obs[k].float()
-                    step_data[k] = step_data[k].float()
-        actions = torch.from_numpy(actions).view(args.num_envs, -1).float()
-        rewards = torch.from_numpy(rewards).view(args.num_envs, -1).float()
-        dones = torch.from_numpy(dones).view(args.num_envs, -1).float()
+        if len(mlp_keys) > 0:
+            np.concatenate([o[k].reshape(args.num_envs, -1) for k in mlp_keys], axis=-1, out=packed_mlp_obs)
+        for k in obs_keys:  # [N_envs, N_obs]
+            if k in mlp_keys:
+                next_obs[k] = packed_mlp_views[k]
+            else:
+                # The vectorized environments already stack the observations as [N_envs, ...]
+                next_obs[k] = torch.as_tensor(o[k])
+            if len(final_obs_idxes) == 0:
+                step_data[k] = next_obs[k]
+            else:
+                step_data[k] = next_obs[k].clone()
+                for idx in final_obs_idxes:
+                    step_data[k][idx] = torch.as_tensor(infos["final_observation"][idx][k])
+        np.copyto(actions_buf.numpy(), actions.reshape(args.num_envs, -1))
+        np.copyto(rewards_buf.numpy(), rewards.reshape(args.num_envs, -1))
+        clip_rewards_fn(rewards_buf.numpy())
+        np.copyto(dones_buf.numpy(), dones.reshape(args.num_envs, -1))
+        actions, rewards, dones = actions_buf, rewards_buf, dones_buf
 
         # Next_obs becomes the new obs
         obs = next_obs
 
         step_data["dones"] = dones
         step_data["actions"] = actions
-        step_data["rewards"] = clip_rewards_fn(rewards)
+        step_data["rewards"] = rewards
         if buffer_type == "sequential":
             rb.add(step_data[None, ...])
         else:
-            for i, env_ep in enumerate(episode_steps):
-                env_ep.append(step_data[i : i + 1][None, ...])
+            add_episode_steps(step_data, range(args.num_envs))
 
         # Reset and save the observation coming from the automatic reset
-        dones_idxes = dones.nonzero(as_tuple=True)[0].tolist()
         reset_envs = len(dones_idxes)
         if reset_envs > 0:
             reset_data = TensorDict({}, batch_size=[reset_envs], device="cpu")
             for k in next_obs.keys():
                 reset_data[k] = next_obs[k][dones_idxes]
-            reset_data["dones"] = torch.zeros(reset_envs, 1)
-            reset_data["actions"] = torch.zeros(reset_envs, np.sum(actions_dim))
-            reset_data["rewards"] = torch.zeros(reset_envs, 1)
-            reset_data["is_first"] = torch.ones_like(reset_data["dones"])
+            reset_data["dones"] = reset_zeros.expand(reset_envs, -1)
+            reset_data["actions"] = reset_actions.expand(reset_envs, -1)
+            reset_data["rewards"] = reset_zeros.expand(reset_envs, -1)
+            reset_data["is_first"] = reset_is_first.expand(reset_envs, -1)
             if buffer_type == "episode":
-                for i, d in enumerate(dones_idxes):
-                    if len(episode_steps[d]) >= args.per_rank_sequence_length:
-                        rb.add(torch.cat(episode_steps[d], dim=0))
-                        episode_steps[d] = [reset_data[i : i + 1][None, ...]]
+                for d in dones_idxes:
+                    ep_len = int(episode_lengths[d])
+                    if ep_len >= args.per_rank_sequence_length:
+                        rb.add(
+                            TensorDict(
+                                {k: v[:ep_len, d : d + 1].clone() for k, v in episode_steps.items()},
+                                batch_size=[ep_len, 1],
+                            )
+                        )
+                    # Episodes shorter than the sequence length are discarded
+                    episode_lengths[d] = 0
+                add_episode_steps(reset_data, dones_idxes)
             else:
                 rb.add(reset_data[None, ...], dones_idxes)
             # Reset dones so that `is_first` is updated
-            for d in dones_idxes:
-                step_data["dones"][d] = torch.zeros_like(step_data["dones"][d])
+            step_data["dones"][dones_idxes] = 0.0
             # Reset internal agent states
             player.init_states(dones_idxes)
 
@@ -708,7 +822,6 @@ def main():
 
         # Train the agent
         if global_step >= learning_starts and step_before_training <= 0:
-            fabric.barrier()
             if buffer_type == "sequential":
                 local_data = rb.sample(
                     args.per_rank_batch_size,
@@ -721,12 +834,12 @@ def main():
                     n_samples=args.pretrain_steps if global_step == learning_starts else args.gradient_steps,
                     prioritize_ends=args.prioritize_ends,
                 ).to(device)
-            distributed_sampler = BatchSampler(range(local_data.shape[0]), batch_size=1, drop_last=False)
-            for i in distributed_sampler:
-                if gradient_steps % args.critic_target_network_update_freq == 0:
-                    for cp, tcp in zip(critic.module.parameters(), target_critic.parameters()):
-                        tcp.data.copy_(cp.data)
-                train(
+            for i in range(local_data.shape[0]):
+                if target_update_countdown == 0:
+                    copy_params(target_critic_params, critic_params)
+                    target_update_countdown = args.critic_target_network_update_freq
+                target_update_countdown -= 1
+                train_step(
                     fabric,
                     world_model,
                     actor,
@@ -735,14 +848,14 @@ def main():
                     world_optimizer,
                     actor_optimizer,
                     critic_optimizer,
-                    local_data[i].view(args.per_rank_sequence_length, args.per_rank_batch_size),
+                    local_data[i],
                     aggregator,
                     args,
                     cnn_keys,
                     mlp_keys,
                     actions_dim,
+                    scratch_buffers,
                 )
-                gradient_steps += 1
             step_before_training = args.train_every // single_global_step
             if args.expl_decay:
                 expl_decay_steps += 1
@@ -772,7 +885,7 @@ def main():
                 "actor_optimizer": actor_optimizer.state_dict(),
                 "critic_optimizer": critic_optimizer.state_dict(),
                 "expl_decay_steps": expl_decay_steps,
-                "args": asdict(args),
+                "args": args_dict,
                 "global_step": global_step * fabric.world_size,
                 "batch_size": args.per_rank_batch_size * fabric.world_size,
             }
@@ -785,6 +898,7 @@ def main():
                 replay_buffer=rb if args.checkpoint_buffer else None,
             )
 
+    fabric.call("on_train_end")
     envs.close()
     if fabric.is_global_zero:
         test(player, fabric, args, cnn_keys, mlp_keys)
@@ -1,5 +1,5 @@
 import os
-from typing import TYPE_CHECKING, List, Optional, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Union
 
 import gymnasium as gym
 import numpy as np
@@ -18,6 +18,75 @@ if TYPE_CHECKING:
     from sheeprl.algos.dreamer_v2.args import DreamerV2Args
 
 
+def normalize_image(obs: Tensor) -> Tensor:
+    """
+    Normalize the pixel observations in the range [-0.5, 0.5].
+    The division reads the (possibly uint8) observations and writes a new floating point tensor,
+    then the shift is computed in-place, so that only one temporary tensor is allocated.
+
+    Args:
+        obs (Tensor): the pixel observations in the range [0, 255].
+
+    Returns:
+        The normalized observations.
+    """
+    return torch.div(obs, 255).sub_(0.5)
+
+
+def get_scratch_buffer(
+    buffers: Optional[Dict[str, Tensor]],
+    name: str,
+    shape: Sequence[int],
+    device: Union[torch.device, str],
+    zero: bool = False,
+) -> Tensor:
+    """
+    Return a tensor of the given shape to be used as scratch memory during training.
+    The tensor is allocated once and stored in `buffers`, then it is reused by the following calls
+    (unless a different shape or device is requested).
+    The returned tensor is always detached, so that the computational graph built by the previous
+    training step through in-place writes is not kept alive by the new one.
+
+    Args:
+        buffers (Dict[str, Tensor], optional): the dictionary where the buffers are stored.
+            If None, a new tensor is allocated at every call.
+        name (str): the name of the buffer.
+        shape (Sequence[int]): the shape of the buffer.
+        device (Union[torch.device, str]): the device of the buffer.
+        zero (bool): whether to fill the buffer with zeros.
+            Default to False.
+
+    Returns:
+        The scratch tensor, whose content is undefined if `zero` is False.
+    """
+    buf = buffers.get(name, None) if buffers is not None else None
+    if buf is None or buf.shape != tuple(shape) or buf.device != torch.device(device):
+        buf = torch.empty(*shape, device=device)
+        if buffers is not None:
+            buffers[name] = buf
+    buf = buf.detach()
+    if zero:
+        buf.zero_()
+    return buf
+
+
+@torch.no_grad()
+def copy_params(dst: Sequence[Tensor], src: Sequence[Tensor]) -> None:
+    """
+    Copy the source tensors into the destination ones, e.g. to update the parameters of a target network.
+    If available, a single multi-tensor `torch._foreach_copy_` is used instead of one copy per tensor.
+
+    Args:
+        dst (Sequence[Tensor]): the tensors to be overwritten.
+        src (Sequence[Tensor]): the tensors to copy.
+    """
+    if hasattr(torch, "_foreach_copy_"):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
+
+
 def compute_stochastic_state(logits: Tensor, discrete: int = 32, sample=True) -> Tensor:
     """
     Compute the stochastic state from the logits computed by the transition or representaiton model.
@@ -67,16 +136,42 @@ def compute_lambda_values(
     horizon: int = 15,
     lmbda: float = 0.95,
 ) -> Tensor:
+    """
+    Compute the lambda values of Eq. 4 from [https://arxiv.org/abs/2010.02193](https://arxiv.org/abs/2010.02193).
+    The recursion V_t = a_t + b_t * V_(t+1), with a_t = r_t + c_t * (1 - lmbda) * v_(t+1), b_t = c_t * lmbda
+    and V_horizon = bootstrap, is unrolled as V_t = sum_k (b_t * ... * b_(k-1)) * a_k, where all the products
+    are computed at once with a cumulative product over a (horizon, horizon + 1) matrix of discounts.
+
+    Args:
+        rewards (Tensor): the imagined rewards of shape (horizon, *).
+        values (Tensor): the imagined values of shape (horizon, *).
+        continues (Tensor): the imagined continues (already multiplied by gamma) of shape (horizon, *).
+        bootstrap (Tensor, optional): the value of the last imagined state of shape (1, *).
+            Defaults to None (zeros).
+        horizon (int): the horizon of imagination.
+            Default to 15.
+        lmbda (float): the lambda for the TD lambda values.
+            Default to 0.95.
+
+    Returns:
+        The lambda values of shape (horizon, *).
+    """
     if bootstrap is None:
         bootstrap = torch.zeros_like(values[-1:])
-    agg = bootstrap
     next_val = torch.cat((values[1:], bootstrap), dim=0)
-    inputs = rewards + continues * next_val * (1 - lmbda)
-    lv = []
-    for i in reversed(range(horizon)):
-        agg = inputs[i] + continues[i] * lmbda * agg
-        lv.append(agg)
-    return torch.cat(list(reversed(lv)), dim=0)
+    # a_0, ..., a_(horizon - 1), followed by the bootstrap value, of shape (horizon + 1, *)
+    inputs = torch.cat((rewards + continues * next_val * (1 - lmbda), bootstrap), dim=0)
+    # 1, b_0, ..., b_(horizon - 1), of shape (horizon + 1, *)
+    discounts = torch.cat((torch.ones_like(continues[:1]), continues * lmbda), dim=0)
+    # factors[t, k] = b_(k-1) if k > t else 1, so that their cumulative product over k
+    # is b_t * ... * b_(k-1) for every k > t
+    idxes = torch.arange(horizon + 1, device=inputs.device)
+    view_shape = (horizon, horizon + 1) + (1,) * (inputs.dim() - 1)
+    future = (idxes[None, :] > idxes[:horizon, None]).view(view_shape)
+    factors = torch.where(future, discounts.unsqueeze(0), torch.ones_like(discounts).unsqueeze(0))
+    # the inputs preceding the t-th one do not contribute to the t-th lambda value
+    weights = torch.cumprod(factors, dim=1) * (idxes[None, :] >= idxes[:horizon, None]).view(view_shape)
+    return (weights * inputs.unsqueeze(0)).sum(dim=1)
 
 
 @torch.no_grad()
@@ -117,7 +212,7 @@ def test(
         preprocessed_obs = {}
         for k, v in next_obs.items():
             if k in cnn_keys:
-                preprocessed_obs[k] = v[None, ...].to(device) / 255 - 0.5
+                preprocessed_obs[k] = normalize_image(v[None, ...].to(device))
             elif k in mlp_keys:
                 preprocessed_obs[k] = v[None, ...].to(device)
         real_actions = player.get_greedy_action(
@@ -1,5 +1,6 @@
 from typing import Any, Dict, Optional, Sequence, Tuple
 
+import torch
 from lightning.fabric import Fabric
 from lightning.fabric.wrappers import _FabricModule
 from torch import Tensor, nn
@@ -12,6 +13,34 @@ from sheeprl.models.models import MLP
 from sheeprl.utils.utils import init_weights
 
 
+def ensembles_forward(ensembles: nn.ModuleList, x: Tensor) -> Tensor:
+    """Compute the outputs of all the ensembles on the same input at once.
+    The weights of every linear layer of the ensembles are stacked, so that each layer is computed
+    by a single batched matrix multiplication instead of one matrix multiplication per ensemble.
+    The layers without parameters (e.g., the activations) are shared by all the ensembles.
+    The gradients flow back to the parameters of each ensemble through the stacking,
+    so the ensembles can be trained and checkpointed as separate modules.
+
+    Args:
+        ensembles (nn.ModuleList): the ensembles, all the MLPs with the same architecture.
+        x (Tensor): the input of the ensembles, of shape (*, input_dim).
+
+    Returns:
+        The outputs of the ensembles (Tensor), of shape (num_ensembles, *, output_dim).
+    """
+    out = x.reshape(1, -1, x.shape[-1]).expand(len(ensembles), -1, -1)
+    for layers in zip(*(ens.model for ens in ensembles)):
+        if isinstance(layers[0], nn.Linear):
+            weight = torch.stack([layer.weight for layer in layers]).transpose(1, 2)
+            bias = torch.stack([layer.bias for layer in layers]).unsqueeze(1)
+            out = torch.baddbmm(bias, out, weight)
+        elif next(layers[0].parameters(), None) is None:
+            out = layers[0](out)
+        else:
+            raise ValueError(f"Only the linear layers of the ensembles can have parameters, got: {layers[0]}")
+    return out.reshape(len(ensembles), *x.shape[:-1], out.shape[-1])
+
+
 def build_models(
     fabric: Fabric,
     actions_dim: Sequence[int],
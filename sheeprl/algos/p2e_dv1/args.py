@@ -24,3 +24,8 @@ class P2EDV1Args(DreamerV1Args):
         "steps the actor will be finetuned. "
         "Otherwise the actor will be learned in a zero-shot setting.",
     )
+    log_every: int = Arg(
+        default=1,
+        help="how often (in policy steps) to log the metrics, averaged over the steps since the last logging. "
+        "The metrics are logged only after a training round",
+    )
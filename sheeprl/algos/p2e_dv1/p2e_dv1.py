@@ -1,4 +1,3 @@
-import copy
 import os
 import pathlib
 import time
@@ -23,8 +22,8 @@ from torchmetrics import MeanMetric
 
 from sheeprl.algos.dreamer_v1.agent import PlayerDV1, WorldModel
 from sheeprl.algos.dreamer_v1.loss import actor_loss, critic_loss, reconstruction_loss
-from sheeprl.algos.dreamer_v2.utils import test
-from sheeprl.algos.p2e_dv1.agent import build_models
+from sheeprl.algos.dreamer_v2.utils import normalize_image, test
+from sheeprl.algos.p2e_dv1.agent import build_models, ensembles_forward
 from sheeprl.algos.p2e_dv1.args import P2EDV1Args
 from sheeprl.data.buffers import AsyncReplayBuffer
 from sheeprl.models.models import MLP
@@ -112,38 +111,45 @@ def train(
     batch_size = args.per_rank_batch_size
     sequence_length = args.per_rank_sequence_length
     device = fabric.device
-    batch_obs = {k: data[k] / 255 - 0.5 for k in cnn_keys}
+    batch_obs = {k: normalize_image(data[k]) for k in cnn_keys}
     batch_obs.update({k: data[k] for k in mlp_keys})
+    use_continues = args.use_continues and world_model.continue_model is not None
+
+    # Without the continue model the continues are constant, so the discount of the imagined steps
+    # is the geometric decay gamma^t, computed once for both the exploration and the task learning
+    gamma_decay = None
+    if not use_continues:
+        gamma_decay = args.gamma ** torch.arange(args.horizon - 1, dtype=torch.float32, device=device).view(-1, 1, 1)
 
     # Dynamic Learning
     recurrent_state = torch.zeros(1, batch_size, args.recurrent_state_size, device=device)
     posterior = torch.zeros(1, batch_size, args.stochastic_size, device=device)
-    recurrent_states = torch.empty(sequence_length, batch_size, args.recurrent_state_size, device=device)
-    posteriors = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
-    priors = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
-    posteriors_mean = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
-    posteriors_std = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
-    priors_mean = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
-    priors_std = torch.empty(sequence_length, batch_size, args.stochastic_size, device=device)
+    # the states of every step are concatenated after the loop,
+    # instead of being copied one at a time into pre-allocated tensors tracked by the autograd
+    recurrent_states, posteriors, posteriors_mean, posteriors_std = [], [], [], []
     embedded_obs = world_model.encoder(batch_obs)
 
     for i in range(0, sequence_length):
-        recurrent_state, posterior, prior, posterior_mean_std, prior_mean_std = world_model.rssm.dynamic(
+        recurrent_state, posterior, posterior_mean_std = world_model.rssm.dynamic_posterior(
             posterior, recurrent_state, data["actions"][i : i + 1], embedded_obs[i : i + 1]
         )
-        recurrent_states[i] = recurrent_state
-        posteriors[i] = posterior
-        posteriors_mean[i] = posterior_mean_std[0]
-        posteriors_std[i] = posterior_mean_std[1]
-        priors_mean[i] = prior_mean_std[0]
-        priors_std[i] = prior_mean_std[1]
-        priors[i] = prior
+        recurrent_states.append(recurrent_state)
+        posteriors.append(posterior)
+        posteriors_mean.append(posterior_mean_std[0])
+        posteriors_std.append(posterior_mean_std[1])
+    recurrent_states = torch.cat(recurrent_states, 0)
+    posteriors = torch.cat(posteriors, 0)
+    posteriors_mean = torch.cat(posteriors_mean, 0)
+    posteriors_std = torch.cat(posteriors_std, 0)
+
+    # The prior states depend only on the recurrent states, so the transition model is called once on all of them
+    (priors_mean, priors_std), _ = world_model.rssm._transition(recurrent_states)
     latent_states = torch.cat((posteriors, recurrent_states), -1)
 
     decoded_information: Dict[str, torch.Tensor] = world_model.observation_model(latent_states)
     qo = {k: Independent(Normal(rec_obs, 1), len(rec_obs.shape[2:])) for k, rec_obs in decoded_information.items()}
     qr = Independent(Normal(world_model.reward_model(latent_states.detach()), 1), 1)
-    if args.use_continues and world_model.continue_model:
+    if args.use_continues and world_model.continue_model is not None:
         qc = Independent(Bernoulli(logits=world_model.continue_model(latent_states.detach()), validate_args=False), 1)
         continue_targets = (1 - data["dones"]) * args.gamma
     else:
@@ -181,63 +187,49 @@ def train(
     aggregator.update("State/p_entropy", p.entropy().mean().detach())
     aggregator.update("State/q_entropy", q.entropy().mean().detach())
 
+    # The ensembles and the imagination of both the behaviours are fed with the detached posterior states,
+    # which are detached only once
+    latent_states = latent_states.detach()
+    imagined_prior = posteriors.detach().reshape(1, -1, args.stochastic_size)
+    recurrent_state = recurrent_states.detach().reshape(1, -1, args.recurrent_state_size)
+
     if is_exploring:
         # Ensemble Learning
-        loss = 0.0
         ensemble_optimizer.zero_grad(set_to_none=True)
-        for ens in ensembles:
-            out = ens(torch.cat((posteriors.detach(), recurrent_states.detach(), data["actions"].detach()), -1))[:-1]
-            next_obs_embedding_dist = Independent(Normal(out, 1), 1)
-            loss -= next_obs_embedding_dist.log_prob(embedded_obs.detach()[1:]).mean()
+        # out -> N_ensemble x (Seq_len - 1) x Batch_size x Obs_embedding_size
+        out = ensembles_forward(ensembles, torch.cat((latent_states, data["actions"]), -1))[:, :-1]
+        next_obs_embedding_dist = Independent(Normal(out, 1), 1)
+        # the loss is the sum of the losses of the ensembles, each one averaged over the sequence and the batch
+        loss = -next_obs_embedding_dist.log_prob(embedded_obs.detach()[1:]).mean((1, 2)).sum()
         loss.backward()
         if args.ensemble_clip_gradients is not None and args.ensemble_clip_gradients > 0:
             ensemble_grad = fabric.clip_gradients(
-                module=ens,
+                module=ensembles,
                 optimizer=ensemble_optimizer,
                 max_norm=args.ensemble_clip_gradients,
                 error_if_nonfinite=False,
             )
             aggregator.update("Grads/ensemble", ensemble_grad.detach())
         ensemble_optimizer.step()
-        aggregator.update("Loss/ensemble_loss", loss.detach().cpu())
+        aggregator.update("Loss/ensemble_loss", loss.detach())
 
         # Behaviour Learning Exploration
-        imagined_prior = posteriors.detach().reshape(1, -1, args.stochastic_size)
-        recurrent_state = recurrent_states.detach().reshape(1, -1, args.recurrent_state_size)
-        imagined_latent_state = torch.cat((imagined_prior, recurrent_state), -1)
-        imagined_trajectories = torch.empty(
-            args.horizon, batch_size * sequence_length, args.stochastic_size + args.recurrent_state_size, device=device
+        # imagine trajectories in the latent space, the imagined actions are used to compute the intrinsic reward
+        imagined_trajectories, imagined_actions = world_model.rssm.imagine_trajectory(
+            imagined_prior, recurrent_state, actor_exploration, args.horizon, return_actions=True
         )
-        # initialize the tensor of imagined actions, they are used to compute the intrinsic reward
-        imagined_actions = torch.zeros(
-            args.horizon, batch_size * sequence_length, data["actions"].shape[-1], device=device
-        )
-
-        # imagine trajectories in the latent space
-        for i in range(args.horizon):
-            actions = torch.cat(actor_exploration(imagined_latent_state.detach())[0], dim=-1)
-            imagined_actions[i] = actions
-            imagined_prior, recurrent_state = world_model.rssm.imagination(imagined_prior, recurrent_state, actions)
-            imagined_latent_state = torch.cat((imagined_prior, recurrent_state), -1)
-            imagined_trajectories[i] = imagined_latent_state
         predicted_values = critic_exploration(imagined_trajectories)
 
         # Predict intrinsic reward
-        next_obs_embedding = torch.zeros(
-            len(ensembles),
-            args.horizon,
-            batch_size * sequence_length,
-            embedded_obs.shape[-1],
-            device=device,
+        next_obs_embedding = ensembles_forward(
+            ensembles, torch.cat((imagined_trajectories.detach(), imagined_actions.detach()), -1)
         )
-        for i, ens in enumerate(ensembles):
-            next_obs_embedding[i] = ens(torch.cat((imagined_trajectories.detach(), imagined_actions.detach()), -1))
 
         # next_obs_embedding -> N_ensemble x Horizon x Batch_size*Seq_len x Obs_embedding_size
         intrinsic_reward = next_obs_embedding.var(0).mean(-1, keepdim=True) * args.intrinsic_reward_multiplier
-        aggregator.update("Rewards/intrinsic", intrinsic_reward.detach().cpu().mean())
+        aggregator.update("Rewards/intrinsic", intrinsic_reward.detach().mean())
 
-        if args.use_continues and world_model.continue_model:
+        if use_continues:
             predicted_continues = Independent(
                 Bernoulli(logits=world_model.continue_model(imagined_trajectories)), 1
             ).mean
@@ -253,13 +245,16 @@ def train(
             lmbda=args.lmbda,
         )
 
-        aggregator.update("Values_exploration/predicted_values", predicted_values.detach().cpu().mean())
-        aggregator.update("Values_exploration/lambda_values", lambda_values.detach().cpu().mean())
+        aggregator.update("Values_exploration/predicted_values", predicted_values.detach().mean())
+        aggregator.update("Values_exploration/lambda_values", lambda_values.detach().mean())
 
-        with torch.no_grad():
-            discount = torch.cumprod(
-                torch.cat((torch.ones_like(predicted_continues[:1]), predicted_continues[:-2]), 0), 0
-            )
+        if use_continues:
+            with torch.no_grad():
+                discount = torch.cumprod(
+                    torch.cat((torch.ones_like(predicted_continues[:1]), predicted_continues[:-2]), 0), 0
+                )
+        else:
+            discount = gamma_decay
 
         actor_exploration_optimizer.zero_grad(set_to_none=True)
         policy_loss_exploration = actor_loss(discount * lambda_values)
@@ -275,7 +270,9 @@ def train(
         actor_exploration_optimizer.step()
         aggregator.update("Loss/policy_loss_exploration", policy_loss_exploration.detach())
 
-        qv = Independent(Normal(critic_exploration(imagined_trajectories.detach())[:-1], 1), 1)
+        # the critic is trained on a detached input, so its values for the actor cannot be reused,
+        # but the value of the last imagined state is not needed
+        qv = Independent(Normal(critic_exploration(imagined_trajectories.detach()[:-1]), 1), 1)
         critic_exploration_optimizer.zero_grad(set_to_none=True)
         value_loss_exploration = critic_loss(qv, lambda_values.detach(), discount[..., 0])
         fabric.backward(value_loss_exploration)
@@ -294,21 +291,13 @@ def train(
     world_optimizer.zero_grad(set_to_none=True)
 
     # Behaviour Learning Task
-    imagined_prior = posteriors.detach().reshape(1, -1, args.stochastic_size)
-    recurrent_state = recurrent_states.detach().reshape(1, -1, args.recurrent_state_size)
-    imagined_latent_state = torch.cat((imagined_prior, recurrent_state), -1)
-    imagined_trajectories = torch.empty(
-        args.horizon, batch_size * sequence_length, args.stochastic_size + args.recurrent_state_size, device=device
+    imagined_trajectories = world_model.rssm.imagine_trajectory(
+        imagined_prior, recurrent_state, actor_task, args.horizon
     )
-    for i in range(args.horizon):
-        actions = torch.cat(actor_task(imagined_latent_state.detach())[0], dim=-1)
-        imagined_prior, recurrent_state = world_model.rssm.imagination(imagined_prior, recurrent_state, actions)
-        imagined_latent_state = torch.cat((imagined_prior, recurrent_state), -1)
-        imagined_trajectories[i] = imagined_latent_state
 
     predicted_values = critic_task(imagined_trajectories)
     predicted_rewards = world_model.reward_model(imagined_trajectories)
-    if args.use_continues and world_model.continue_model:
+    if use_continues:
         predicted_continues = Independent(Bernoulli(logits=world_model.continue_model(imagined_trajectories)), 1).mean
     else:
         predicted_continues = torch.ones_like(predicted_rewards.detach()) * args.gamma
@@ -322,8 +311,13 @@ def train(
         lmbda=args.lmbda,
     )
 
-    with torch.no_grad():
-        discount = torch.cumprod(torch.cat((torch.ones_like(predicted_continues[:1]), predicted_continues[:-2]), 0), 0)
+    if use_continues:
+        with torch.no_grad():
+            discount = torch.cumprod(
+                torch.cat((torch.ones_like(predicted_continues[:1]), predicted_continues[:-2]), 0), 0
+            )
+    else:
+        discount = gamma_decay
 
     actor_task_optimizer.zero_grad(set_to_none=True)
     policy_loss_task = actor_loss(discount * lambda_values)
@@ -336,7 +330,7 @@ def train(
     actor_task_optimizer.step()
     aggregator.update("Loss/policy_loss_task", policy_loss_task.detach())
 
-    qv = Independent(Normal(critic_task(imagined_trajectories.detach())[:-1], 1), 1)
+    qv = Independent(Normal(critic_task(imagined_trajectories.detach()[:-1]), 1), 1)
     critic_task_optimizer.zero_grad(set_to_none=True)
     value_loss = critic_loss(qv, lambda_values.detach(), discount[..., 0])
     fabric.backward(value_loss)
@@ -348,14 +342,6 @@ def train(
     critic_task_optimizer.step()
     aggregator.update("Loss/value_loss_task", value_loss.detach())
 
-    # Reset everything
-    actor_exploration_optimizer.zero_grad(set_to_none=True)
-    critic_exploration_optimizer.zero_grad(set_to_none=True)
-    actor_task_optimizer.zero_grad(set_to_none=True)
-    critic_task_optimizer.zero_grad(set_to_none=True)
-    world_optimizer.zero_grad(set_to_none=True)
-    ensemble_optimizer.zero_grad(set_to_none=True)
-
 
 @register_algorithm()
 def main():
@@ -374,6 +360,7 @@ def main():
     device = fabric.device
     fabric.seed_everything(args.seed)
     torch.backends.cudnn.deterministic = args.torch_deterministic
+    torch.set_float32_matmul_precision(args.float32_matmul_precision)
 
     if args.checkpoint_path:
         state = fabric.load(args.checkpoint_path)
@@ -489,6 +476,9 @@ def main():
         args.stochastic_size,
         args.recurrent_state_size,
         fabric.device,
+        jit_inference=args.jit_inference,
+        cuda_graph=args.cuda_graph_inference,
+        bf16=args.bf16_inference,
     )
 
     # Optimizers
@@ -551,7 +541,8 @@ def main():
                 "Grads/actor_exploration": MeanMetric(sync_on_compute=False),
                 "Grads/critic_exploration": MeanMetric(sync_on_compute=False),
                 "Grads/ensemble": MeanMetric(sync_on_compute=False),
-            }
+            },
+            lazy_updates=True,
         )
     aggregator.to(device)
 
@@ -574,15 +565,20 @@ def main():
             rb = state["rb"]
         else:
             raise RuntimeError(f"Given {len(state['rb'])}, but {fabric.world_size} processes are instantiated")
-    step_data = TensorDict({}, batch_size=[args.num_envs], device="cpu")
+    # The step data has the time dimension of the buffer, so that it can be added without being wrapped
+    step_data = TensorDict({}, batch_size=[1, args.num_envs], device="cpu")
     expl_decay_steps = state["expl_decay_steps"] if args.checkpoint_path else 0
 
     # Global variables
-    start_time = time.perf_counter()
     start_step = state["global_step"] // fabric.world_size if args.checkpoint_path else 1
+    # The policy step and the time of the last logging, used to measure the steps per second since then
+    last_log = start_step - 1
+    last_log_time = time.perf_counter()
     single_global_step = int(args.num_envs * fabric.world_size * args.action_repeat)
     step_before_training = args.train_every // single_global_step if not args.dry_run else 0
     num_updates = int(args.total_steps // single_global_step) if not args.dry_run else 1
+    if args.log_every <= 0:
+        raise ValueError(f"The logging frequency must be greater than zero, got: {args.log_every}")
     learning_starts = (args.learning_starts // single_global_step) if not args.dry_run else 0
     exploration_updates = (
         int(args.exploration_steps // (fabric.world_size * args.action_repeat)) if not args.dry_run else 4
@@ -606,14 +602,24 @@ def main():
         torch_obs = torch.from_numpy(o[k]).view(args.num_envs, *o[k].shape[1:])
         if k in mlp_keys:
             torch_obs = torch_obs.float()
-        step_data[k] = torch_obs
+        step_data[k] = torch_obs[None]
         obs[k] = torch_obs
-    step_data["dones"] = torch.zeros(args.num_envs, 1)
-    step_data["actions"] = torch.zeros(args.num_envs, sum(actions_dim))
-    step_data["rewards"] = torch.zeros(args.num_envs, 1)
-    rb.add(step_data[None, ...])
+    step_data["dones"] = torch.zeros(1, args.num_envs, 1)
+    step_data["actions"] = torch.zeros(1, args.num_envs, sum(actions_dim))
+    step_data["rewards"] = torch.zeros(1, args.num_envs, 1)
+    rb.add(step_data)
     player.init_states()
 
+    # The observations given to the player are staged in page-locked memory, to be copied asynchronously
+    # to the GPU: the staging tensors are reused at every step, since the actions are synchronously read back
+    staging_obs = {k: torch.empty_like(v).pin_memory() for k, v in obs.items()} if device.type == "cuda" else None
+
+    # Float buffers for the actions, rewards and dones of the current step:
+    # `rb.add` copies them into the buffer storage, so they are overwritten at the next step
+    actions_buf = torch.empty(1, args.num_envs, sum(actions_dim))
+    rewards_buf = torch.empty(1, args.num_envs, 1)
+    dones_buf = torch.empty(1, args.num_envs, 1)
+
     is_exploring = True
     for global_step in range(start_step, num_updates + 1):
         if global_step == exploration_updates:
@@ -638,10 +644,13 @@ def main():
             with torch.no_grad():
                 preprocessed_obs = {}
                 for k, v in obs.items():
+                    if staging_obs is not None:
+                        v = staging_obs[k].copy_(v)
+                    v = v[None, ...].to(device, non_blocking=True)
                     if k in cnn_keys:
-                        preprocessed_obs[k] = v[None, ...].to(device) / 255 - 0.5
+                        preprocessed_obs[k] = normalize_image(v)
                     else:
-                        preprocessed_obs[k] = v[None, ...].to(device)
+                        preprocessed_obs[k] = v
                 mask = {k: v for k, v in preprocessed_obs.items() if k.startswith("mask")}
                 if len(mask) == 0:
                     mask = None
@@ -664,37 +673,37 @@ def main():
                     aggregator.update("Rewards/rew_avg", agent_final_info["episode"]["r"][0])
                     aggregator.update("Game/ep_len_avg", agent_final_info["episode"]["l"][0])
 
-        # Save the real next observation
-        real_next_obs = copy.deepcopy(o)
+        # Save the real next observation: the observations of the step data are cloned only if
+        # some environments have been reset, to store their final observations without modifying `next_obs`
+        final_obs_idxes = []
         if "final_observation" in infos:
-            for idx, final_obs in enumerate(infos["final_observation"]):
-                if final_obs is not None:
-                    for k, v in final_obs.items():
-                        if k == "rgb":
-                            real_next_obs[idx] = v
-
+            final_obs_idxes = [i for i, final_obs in enumerate(infos["final_observation"]) if final_obs is not None]
         next_obs = {}
-        for k in real_next_obs.keys():  # [N_envs, N_obs]
-            next_obs[k] = torch.from_numpy(o[k]).view(args.num_envs, *o[k].shape[1:])
-            step_data[k] = torch.from_numpy(real_next_obs[k]).view(args.num_envs, *real_next_obs[k].shape[1:])
+        for k in o.keys():  # [N_envs, N_obs]
+            next_obs[k] = torch.from_numpy(o[k])
             if k in mlp_keys:
                 next_obs[k] = next_obs[k].float()
-                step_data[k] = step_data[k].float()
-        actions = torch.from_numpy(actions).view(args.num_envs, -1).float()
-        rewards = torch.from_numpy(rewards).view(args.num_envs, -1).float()
-        dones = torch.from_numpy(dones).view(args.num_envs, -1).float()
+            if len(final_obs_idxes) == 0:
+                step_data[k] = next_obs[k][None]
+            else:
+                step_data[k] = next_obs[k][None].clone()
+                for idx in final_obs_idxes:
+                    step_data[k][0, idx] = torch.as_tensor(infos["final_observation"][idx][k])
+        np.copyto(actions_buf.numpy(), actions.reshape(1, args.num_envs, -1))
+        np.copyto(rewards_buf.numpy(), rewards.reshape(1, args.num_envs, -1))
+        np.copyto(dones_buf.numpy(), dones.reshape(1, args.num_envs, -1))
+        actions, rewards, dones = actions_buf, rewards_buf, dones_buf
 
         # next_obs becomes the new obs
         obs = next_obs
 
         step_data["dones"] = dones
         step_data["actions"] = actions
-        step_data["observations"] = obs
         step_data["rewards"] = clip_rewards_fn(rewards)
-        rb.add(step_data[None, ...])
+        rb.add(step_data)
 
         # Reset and save the observation coming from the automatic reset
-        dones_idxes = dones.nonzero(as_tuple=True)[0].tolist()
+        dones_idxes = dones[0].nonzero(as_tuple=True)[0].tolist()
         reset_envs = len(dones_idxes)
         if reset_envs > 0:
             reset_data = TensorDict({}, batch_size=[reset_envs], device="cpu")
@@ -706,7 +715,7 @@ def main():
             rb.add(reset_data[None, ...], dones_idxes)
             # Reset dones so that `is_first` is updated
             for d in dones_idxes:
-                step_data["dones"][d] = torch.zeros_like(step_data["dones"][d])
+                step_data["dones"][0, d] = torch.zeros_like(step_data["dones"][0, d])
             # Reset internal agent states
             player.init_states(dones_idxes)
 
@@ -714,7 +723,6 @@ def main():
 
         # Train the agent
         if global_step >= learning_starts and step_before_training <= 0:
-            fabric.barrier()
             local_data = rb.sample(
                 args.per_rank_batch_size,
                 sequence_length=args.per_rank_sequence_length,
@@ -753,9 +761,14 @@ def main():
                     max_decay_steps=max_step_expl_decay,
                 )
             aggregator.update("Params/exploration_amout", player.expl_amount)
-        aggregator.update("Time/step_per_second", int(global_step / (time.perf_counter() - start_time)))
-        fabric.log_dict(aggregator.compute(), global_step)
-        aggregator.reset()
+
+            # The metrics are computed and logged only after a training round, when most of them have changed
+            if global_step - last_log >= args.log_every or global_step == num_updates:
+                log_time = time.perf_counter()
+                aggregator.update("Time/step_per_second", int((global_step - last_log) / (log_time - last_log_time)))
+                fabric.log_dict(aggregator.compute(), global_step)
+                aggregator.reset()
+                last_log, last_log_time = global_step, log_time
 
         # Checkpoint Model
         if (
@@ -790,6 +803,11 @@ def main():
                 replay_buffer=rb if args.checkpoint_buffer else None,
             )
 
+    # Log the metrics collected after the last training round
+    if last_log < num_updates:
+        fabric.log_dict(aggregator.compute(), num_updates)
+        aggregator.reset()
+
     envs.close()
     # task test few-shot
     if fabric.is_global_zero:
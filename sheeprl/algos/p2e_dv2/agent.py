@@ -139,6 +139,7 @@ def build_models(
     target_critic_task = copy.deepcopy(critic_task.module)
     if target_critic_task_state:
         target_critic_task.load_state_dict(target_critic_task_state)
+    target_critic_task.requires_grad_(False)
 
     return (
         world_model,
@@ -124,7 +124,7 @@ def train(
     device = fabric.device
     batch_obs = {k: data[k] / 255 - 0.5 for k in cnn_keys}
     batch_obs.update({k: data[k] for k in mlp_keys})
-    data["is_first"][0, :] = torch.tensor([1.0], device=fabric.device).expand_as(data["is_first"][0, :])
+    data["is_first"][0, :] = 1.0
 
     # Dynamic Learning
     recurrent_state = torch.zeros(1, batch_size, args.recurrent_state_size, device=device)
@@ -260,7 +260,7 @@ def train(
             data["actions"].shape[-1],
             device=device,
         )
-        imagined_actions[0] = torch.zeros(1, batch_size * sequence_length, data["actions"].shape[-1])
+        imagined_actions[0].zero_()
 
         # imagine trajectories in the latent space
         for i in range(1, args.horizon + 1):
@@ -378,7 +378,7 @@ def train(
         data["actions"].shape[-1],
         device=device,
     )
-    imagined_actions[0] = torch.zeros(1, batch_size * sequence_length, data["actions"].shape[-1])
+    imagined_actions[0].zero_()
 
     # imagine trajectories in the latent space
     for i in range(1, args.horizon + 1):
@@ -26,3 +26,26 @@ class RecurrentPPOArgs(PPOArgs):
         help="the dimension of the hidden sizes of the pre-lstm single-layer critic network. "
         "If None, no pre-lstm network will be used",
     )
+    async_checkpoint: bool = Arg(
+        default=False,
+        help="whether to write the checkpoints in a background thread, while the training goes on",
+    )
+    bf16_buffer_states: bool = Arg(
+        default=False,
+        help="whether to store the recurrent states in the buffer in bfloat16, halving their memory. "
+        "They are cast back to float32 before being given to the agent during training",
+    )
+    bf16_forward: bool = Arg(
+        default=False,
+        help="whether to compute the forward passes of the agent, both in the rollout and in the training, "
+        "in bfloat16 mixed precision. The losses and the sampling of the actions are computed in float32",
+    )
+    compile_train: bool = Arg(
+        default=False,
+        help="whether to compile the computation of the losses with `torch.compile` (requires PyTorch 2.0)",
+    )
+    compile_train_mode: str = Arg(
+        default="default",
+        help="the `torch.compile` mode of the losses computation, one of 'default', 'reduce-overhead' "
+        "(which also captures the compiled graphs in CUDA graphs) or 'max-autotune'",
+    )
@@ -1,24 +1,23 @@
-import copy
-import itertools
 import os
 import time
 import warnings
 from contextlib import nullcontext
 from dataclasses import asdict
+from functools import partial
 from math import prod
-from typing import List
+from typing import Callable, Tuple
 
 import gymnasium as gym
 import numpy as np
 import torch
+import torch.nn.functional as F
 from lightning.fabric import Fabric
 from lightning.fabric.fabric import _is_using_cli
 from tensordict import TensorDict
-from tensordict.tensordict import TensorDictBase, pad_sequence
+from tensordict.tensordict import TensorDictBase
+from torch import Tensor
 from torch.distributed.algorithms.join import Join
-from torch.distributions import Categorical
 from torch.optim import Adam
-from torch.utils.data.sampler import BatchSampler, RandomSampler
 from torchmetrics import MeanMetric
 
 from sheeprl.algos.ppo.loss import entropy_loss, policy_loss, value_loss
@@ -32,7 +31,79 @@ from sheeprl.utils.logger import create_tensorboard_logger
 from sheeprl.utils.metric import MetricAggregator
 from sheeprl.utils.parser import HfArgumentParser
 from sheeprl.utils.registry import register_algorithm
-from sheeprl.utils.utils import gae, normalize_tensor, polynomial_decay
+from sheeprl.utils.utils import compile_train_fn, gae, normalize_tensor, polynomial_decay
+
+
+def compute_losses(
+    action_logits: Tensor,
+    new_values: Tensor,
+    actions: Tensor,
+    logprobs: Tensor,
+    advantages: Tensor,
+    values: Tensor,
+    returns: Tensor,
+    mask: Tensor,
+    clip_coef: Tensor,
+    vf_coef: Tensor,
+    ent_coef: Tensor,
+    clip_vloss: bool,
+    normalize_advantages: bool,
+) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """Compute the PPO losses on the valid steps of a batch of padded sequences.
+    The function only operates on tensors, so that it can be compiled with `torch.compile`:
+    the coefficients are given as tensors, since they can be annealed during the training
+    and a change of a Python float would recompile the function.
+
+    Args:
+        action_logits (Tensor): the logits of the actions computed by the agent.
+        new_values (Tensor): the values computed by the agent.
+        actions (Tensor): the actions played in the environment.
+        logprobs (Tensor): the log-probs of the actions played in the environment.
+        advantages (Tensor): the advantages.
+        values (Tensor): the values estimated during the rollout.
+        returns (Tensor): the returns.
+        mask (Tensor): boolean mask with the valid steps of the sequences,
+            with the same number of elements as the other tensors but the logits.
+        clip_coef (Tensor): the clipping coefficient.
+        vf_coef (Tensor): the coefficient of the value loss.
+        ent_coef (Tensor): the coefficient of the entropy loss.
+        clip_vloss (bool): whether to clip the value loss.
+        normalize_advantages (bool): whether to normalize the advantages.
+
+    Returns:
+        the overall loss
+        the policy loss
+        the value loss
+        the entropy loss
+    """
+    # A single log-softmax gives both the log-probs of the actions and the entropy
+    action_logprobs = F.log_softmax(action_logits, dim=-1)
+    new_logprobs = action_logprobs.gather(-1, actions.long())
+    entropy = -(action_logprobs.exp() * action_logprobs).sum(-1, keepdim=True)
+
+    # The valid steps are found once and gathered from every flattened operand,
+    # instead of being searched again by a boolean indexing for each of them
+    valid_idxes = mask.reshape(-1).nonzero(as_tuple=True)[0]
+
+    def valid(x: Tensor) -> Tensor:
+        return x.reshape(-1).index_select(0, valid_idxes)
+
+    normalized_advantages = valid(advantages)
+    if normalize_advantages and len(normalized_advantages) > 1:
+        normalized_advantages = normalize_tensor(normalized_advantages)
+
+    # Policy loss
+    pg_loss = policy_loss(valid(new_logprobs), valid(logprobs), normalized_advantages, clip_coef, "mean")
+
+    # Value loss
+    v_loss = value_loss(valid(new_values), valid(values), valid(returns), clip_coef, clip_vloss, "mean")
+
+    # Entropy loss
+    ent_loss = entropy_loss(valid(entropy), "mean")
+
+    # Equation (9) in the paper
+    loss = pg_loss + vf_coef * v_loss + ent_coef * ent_loss
+    return loss, pg_loss, v_loss, ent_loss
 
 
 def train(
@@ -42,6 +113,7 @@ def train(
     data: TensorDictBase,
     aggregator: MetricAggregator,
     args: RecurrentPPOArgs,
+    compute_losses_fn: Callable[..., Tuple[Tensor, Tensor, Tensor, Tensor]] = compute_losses,
 ):
     num_sequences = data.shape[1]
     if args.per_rank_num_batches > 0:
@@ -49,53 +121,43 @@ def train(
         batch_size = batch_size if batch_size > 0 else num_sequences
     else:
         batch_size = 1
+    clip_coef, vf_coef, ent_coef = torch.tensor([args.clip_coef, args.vf_coef, args.ent_coef], device=fabric.device)
+    autocast = partial(torch.autocast, device_type=fabric.device.type, dtype=torch.bfloat16, enabled=args.bf16_forward)
+    # The initial recurrent states of the sequences are stacked once, so that the states
+    # of every batch are gathered together: [4, 1, Num_seq, Hidden_size].
+    # They are cast back to float32 if they have been stored in bfloat16
+    initial_states = torch.stack(
+        [data["actor_hxs"][:1], data["actor_cxs"][:1], data["critic_hxs"][:1], data["critic_cxs"][:1]], dim=0
+    ).float()
     with Join([agent._forward_module]) if fabric.world_size > 1 else nullcontext():
         for _ in range(args.update_epochs):
-            states = ((data["actor_hxs"], data["actor_cxs"]), (data["critic_hxs"], data["critic_cxs"]))
-            sampler = BatchSampler(
-                RandomSampler(range(num_sequences)),
-                batch_size=batch_size,
-                drop_last=False,
-            )  # Random sampling sequences
-            for idxes in sampler:
+            # Random sampling sequences: the permutation is split into batches of `batch_size` sequences
+            # (the last one may be smaller), directly on the device of the data
+            for idxes in torch.randperm(num_sequences, device=data.device).split(batch_size):
                 batch = data[:, idxes]
                 mask = batch["mask"].unsqueeze(-1)
-                action_logits, new_values, _ = agent(
-                    batch["observations"],
-                    state=tuple([tuple([s[:1, idxes] for s in state]) for state in states]),
-                    mask=mask,
-                )
-                dist = Categorical(logits=action_logits.unsqueeze(-2))
-
-                normalized_advantages = batch["advantages"][mask]
-                if args.normalize_advantages and len(normalized_advantages) > 1:
-                    normalized_advantages = normalize_tensor(normalized_advantages)
-
-                # Policy loss
-                pg_loss = policy_loss(
-                    dist.log_prob(batch["actions"])[mask],
-                    batch["logprobs"][mask],
-                    normalized_advantages,
-                    args.clip_coef,
-                    "mean",
-                )
-
-                # Value loss
-                v_loss = value_loss(
-                    new_values[mask],
-                    batch["values"][mask],
-                    batch["returns"][mask],
-                    args.clip_coef,
+                actor_hxs, actor_cxs, critic_hxs, critic_cxs = initial_states.index_select(2, idxes)
+                # Only the forward pass of the agent can be computed in bfloat16, the losses are computed in float32
+                with autocast():
+                    action_logits, new_values, _ = agent(
+                        batch["observations"], state=((actor_hxs, actor_cxs), (critic_hxs, critic_cxs)), mask=mask
+                    )
+                loss, pg_loss, v_loss, ent_loss = compute_losses_fn(
+                    action_logits.float(),
+                    new_values.float(),
+                    batch["actions"],
+                    batch["logprobs"],
+                    batch["advantages"],
+                    batch["values"],
+                    batch["returns"],
+                    mask,
+                    clip_coef,
+                    vf_coef,
+                    ent_coef,
                     args.clip_vloss,
-                    "mean",
+                    args.normalize_advantages,
                 )
 
-                # Entropy loss
-                ent_loss = entropy_loss(dist.entropy()[mask], "mean")
-
-                # Equation (9) in the paper
-                loss = pg_loss + args.vf_coef * v_loss + args.ent_coef * ent_loss
-
                 optimizer.zero_grad(set_to_none=True)
                 fabric.backward(loss)
                 if args.max_grad_norm > 0.0:
@@ -112,14 +174,14 @@ def train(
 def main():
     parser = HfArgumentParser(RecurrentPPOArgs)
     args: RecurrentPPOArgs = parser.parse_args_into_dataclasses()[0]
-    initial_ent_coef = copy.deepcopy(args.ent_coef)
-    initial_clip_coef = copy.deepcopy(args.clip_coef)
+    initial_ent_coef = args.ent_coef
+    initial_clip_coef = args.clip_coef
 
     if args.share_data:
         warnings.warn("The script has been called with --share-data: with recurrent PPO only gradients are shared")
 
     # Initialize Fabric
-    fabric = Fabric(callbacks=[CheckpointCallback()])
+    fabric = Fabric(callbacks=[CheckpointCallback(async_save=args.async_checkpoint)])
     if not _is_using_cli():
         fabric.launch()
     rank = fabric.global_rank
@@ -201,10 +263,19 @@ def main():
 
     # Global variables
     global_step = 0
+    autocast = partial(torch.autocast, device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16_forward)
+    states_dtype = torch.bfloat16 if args.bf16_buffer_states else torch.float32
     start_time = time.perf_counter()
     single_global_rollout = int(args.num_envs * args.rollout_steps * world_size)
     num_updates = args.total_steps // single_global_rollout if not args.dry_run else 1
 
+    if args.compile_train:
+        # Only the losses are compiled: the agent packs the padded sequences, whose lengths are read on the CPU.
+        # The number of valid steps changes from batch to batch, so the compiled graphs are dynamic
+        compute_losses_fn = compile_train_fn(compute_losses, mode=args.compile_train_mode, dynamic=True)
+    else:
+        compute_losses_fn = compute_losses
+
     # Linear learning rate scheduler
     if args.anneal_lr:
         from torch.optim.lr_scheduler import PolynomialLR
@@ -217,25 +288,50 @@ def main():
         next_done = torch.zeros(1, args.num_envs, 1, dtype=torch.float32)  # [1, N_envs, 1]
         next_state = agent.initial_states
 
+    # Page-locked staging tensors for the observations, the dones and the rewards of a step, so that they are
+    # copied asynchronously to the GPU. They are overwritten at every step only after the actions have been
+    # read back on the CPU, which waits also for the copies of the previous step
+    if device.type == "cuda":
+        staging_obs = torch.empty_like(next_obs, device="cpu").pin_memory()
+        staging_done = torch.empty_like(next_done, device="cpu").pin_memory()
+        staging_reward = torch.empty_like(next_done, device="cpu").pin_memory()
+        # The actions are read back into a reused page-locked tensor too, instead of a new pageable one
+        staging_action = torch.empty(1, args.num_envs, 1, dtype=torch.long).pin_memory()
+
     for update in range(1, num_updates + 1):
         for _ in range(0, args.rollout_steps):
             global_step += args.num_envs * world_size
 
             with torch.no_grad():
                 # Sample an action given the observation received by the environment
-                action_logits, values, state = agent.module(next_obs, state=next_state)
-                dist = Categorical(logits=action_logits.unsqueeze(-2))
-                action = dist.sample()
-                logprob = dist.log_prob(action)
+                with autocast():
+                    action_logits, values, state = agent.module(next_obs, state=next_state)
+                action_logits, values = action_logits.float(), values.float()
+                action_logprobs = F.log_softmax(action_logits, dim=-1)
+                action = torch.multinomial(action_logprobs.exp().view(args.num_envs, -1), 1).view(1, args.num_envs, 1)
+                logprob = action_logprobs.gather(-1, action)
 
             # Single environment step
-            obs, reward, done, truncated, info = envs.step(action.cpu().numpy().reshape(envs.action_space.shape))
+            if device.type == "cuda":
+                staging_action.copy_(action, non_blocking=True)
+                torch.cuda.current_stream(device).synchronize()
+                env_action = staging_action.numpy()
+            else:
+                env_action = action.numpy()
+            obs, reward, done, truncated, info = envs.step(env_action.reshape(envs.action_space.shape))
             done = np.logical_or(done, truncated)
 
-            with device:
-                obs = torch.tensor(obs, dtype=torch.float32).unsqueeze(0)  # [1, N_envs, N_obs]
-                done = torch.tensor(done, dtype=torch.float32).view(1, args.num_envs, -1)  # [1, N_envs, 1]
-                reward = torch.tensor(reward, dtype=torch.float32).view(1, args.num_envs, -1)  # [1, N_envs, 1]
+            obs = torch.from_numpy(obs).unsqueeze(0)  # [1, N_envs, N_obs]
+            done = torch.from_numpy(done).view(1, args.num_envs, -1)  # [1, N_envs, 1]
+            reward = torch.from_numpy(reward).view(1, args.num_envs, -1)  # [1, N_envs, 1]
+            if device.type == "cuda":
+                obs = staging_obs.copy_(obs).to(device, non_blocking=True)
+                done = staging_done.copy_(done).to(device, non_blocking=True)
+                reward = staging_reward.copy_(reward).to(device, non_blocking=True)
+            else:
+                obs = obs.to(device, dtype=torch.float32)
+                done = done.to(device, dtype=torch.float32)
+                reward = reward.to(device, dtype=torch.float32)
 
             step_data["dones"] = next_done
             step_data["values"] = values
@@ -243,10 +339,10 @@ def main():
             step_data["rewards"] = reward
             step_data["logprobs"] = logprob
             step_data["observations"] = next_obs
-            step_data["actor_hxs"] = next_state[0][0]
-            step_data["actor_cxs"] = next_state[0][1]
-            step_data["critic_hxs"] = next_state[1][0]
-            step_data["critic_cxs"] = next_state[1][1]
+            step_data["actor_hxs"] = next_state[0][0].to(states_dtype)
+            step_data["actor_cxs"] = next_state[0][1].to(states_dtype)
+            step_data["critic_hxs"] = next_state[1][0].to(states_dtype)
+            step_data["critic_cxs"] = next_state[1][1].to(states_dtype)
 
             # Append data to buffer
             rb.add(step_data)
@@ -255,9 +351,12 @@ def main():
             next_obs = obs
             next_done = done
             if args.reset_recurrent_state_on_done:
-                next_state = tuple([tuple([(1 - done) * e for e in s]) for s in state])
-            else:
-                next_state = state
+                # The states returned by the LSTMs are used only as the next states,
+                # so those of the environments that are done are zeroed in place, without allocating new states
+                not_done = 1 - done
+                for s in (*state[0], *state[1]):
+                    s.mul_(not_done)
+            next_state = state
 
             if "final_info" in info:
                 for i, agent_final_info in enumerate(info["final_info"]):
@@ -270,7 +369,9 @@ def main():
 
         # Estimate returns with GAE (https://arxiv.org/abs/1506.02438)
         with torch.no_grad():
-            next_value, _ = agent.module.get_values(next_obs, critic_state=next_state[1])
+            with autocast():
+                next_value, _ = agent.module.get_values(next_obs, critic_state=next_state[1])
+            next_value = next_value.float()
             returns, advantages = gae(
                 rb["rewards"],
                 rb["values"],
@@ -282,39 +383,53 @@ def main():
                 args.gae_lambda,
             )
 
-            # Add returns and advantages to the buffer
-            rb["returns"] = returns.float()
-            rb["advantages"] = advantages.float()
+            # Add returns and advantages to the buffer: the GAE is already computed in float32 and,
+            # from the second update on, the buffer copies them into the slots allocated by the first one
+            rb["returns"] = returns
+            rb["advantages"] = advantages
 
-        # Get the training data as a TensorDict
+        # Get the training data as a TensorDict: this is the storage of the buffer itself, not a copy
         local_data = rb.buffer
 
         # Train the agent
 
         # Prepare data
-        # 1. Split data into episodes (for every environment)
-        episodes: List[TensorDictBase] = []
-        for env_id in range(args.num_envs):
-            env_data = local_data[:, env_id]  # [N_steps, *]
-            episode_ends = env_data["dones"].nonzero(as_tuple=True)[0]
-            episode_ends = episode_ends.tolist()
-            episode_ends.append(args.rollout_steps)
-            start = 0
-            for ep_end_idx in episode_ends:
-                stop = ep_end_idx
-                # Do not include the done, since when we encounter a done it means that
-                # the episode has started
-                episode = env_data[start:stop]
-                if len(episode) > 0:
-                    episodes.append(episode)
-                start = stop
+        # 1. Split data into episodes (for every environment): an episode starts at the first step and at
+        # every done, since when we encounter a done it means that the episode has started.
+        # The transposed dones are sorted by environment, so all the episodes are found at once
+        episodes_first_steps = local_data["dones"][..., 0].T.cpu().numpy() != 0  # [N_envs, N_steps]
+        episodes_first_steps[:, 0] = True
+        episodes_envs, episodes_starts = np.nonzero(episodes_first_steps)
+        episodes_stops = np.append(episodes_starts[1:], args.rollout_steps)
+        episodes_stops[np.append(episodes_envs[1:] != episodes_envs[:-1], True)] = args.rollout_steps
+        episodes_lengths = episodes_stops - episodes_starts
         # 2. Split every episode into sequences of length `per_rank_batch_size`
         if args.per_rank_batch_size is not None and args.per_rank_batch_size > 0:
-            sequences = list(itertools.chain.from_iterable([ep.split(args.per_rank_batch_size) for ep in episodes]))
+            num_splits = -(-episodes_lengths // args.per_rank_batch_size)
+            sequences_episodes = np.repeat(np.arange(len(num_splits)), num_splits)
+            first_splits = np.repeat(np.cumsum(num_splits) - num_splits, num_splits)
+            splits_offsets = (np.arange(len(sequences_episodes)) - first_splits) * args.per_rank_batch_size
+            sequences_envs = episodes_envs[sequences_episodes]
+            sequences_starts = episodes_starts[sequences_episodes] + splits_offsets
+            sequences_lengths = np.minimum(
+                episodes_lengths[sequences_episodes] - splits_offsets, args.per_rank_batch_size
+            )
         else:
-            sequences = episodes
-        padded_sequences = pad_sequence(sequences, batch_first=False, return_mask=True)  # [Seq_len, Num_seq, *]
-        train(fabric, agent, optimizer, padded_sequences, aggregator, args)
+            sequences_envs, sequences_starts, sequences_lengths = episodes_envs, episodes_starts, episodes_lengths
+        # 3. Gather the padded sequences of every key with a single indexing, then zero the padding
+        sequences_steps = np.arange(sequences_lengths.max())[:, None]
+        mask = torch.as_tensor(sequences_steps < sequences_lengths, device=local_data.device)  # [Seq_len, Num_seq]
+        steps_idxes = torch.as_tensor(
+            np.minimum(sequences_starts + sequences_steps, args.rollout_steps - 1), device=local_data.device
+        )
+        envs_idxes = torch.as_tensor(sequences_envs, device=local_data.device)
+        padding = ~mask
+        padded_sequences = TensorDict({}, batch_size=mask.shape, device=local_data.device)
+        for k, v in local_data.items():
+            v = v[steps_idxes, envs_idxes]
+            padded_sequences[k] = v.masked_fill_(padding.view(*padding.shape, *([1] * (v.dim() - 2))), 0)
+        padded_sequences["mask"] = mask
+        train(fabric, agent, optimizer, padded_sequences, aggregator, args, compute_losses_fn=compute_losses_fn)
 
         if args.anneal_lr:
             fabric.log("Info/learning_rate", scheduler.get_last_lr()[0], global_step)
@@ -352,6 +467,7 @@ def main():
             ckpt_path = os.path.join(log_dir, f"checkpoint/ckpt_{update}_{fabric.global_rank}.ckpt")
             fabric.call("on_checkpoint_coupled", fabric=fabric, ckpt_path=ckpt_path, state=state)
 
+    fabric.call("on_train_end")
     envs.close()
     if fabric.is_global_zero:
         test_env = make_env(
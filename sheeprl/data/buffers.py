@@ -120,12 +120,19 @@ class ReplayBuffer:
         data = data.to(self.device)
         data_len = data.shape[0]
         next_pos = (self._pos + data_len) % self._buffer_size
-        if next_pos < self._pos or (data_len >= self._buffer_size and not self._full):
-            idxes = torch.tensor(
-                list(range(self._pos, self._buffer_size)) + list(range(0, next_pos)), device=self.device
+        if self._pos + data_len <= self._buffer_size:
+            # The data does not wrap around the end of the buffer: it is written into a slice,
+            # without creating the tensor of the indices (e.g. when a single step is added)
+            idxes = slice(self._pos, self._pos + data_len)
+        elif next_pos < self._pos or (data_len >= self._buffer_size and not self._full):
+            idxes = torch.cat(
+                (
+                    torch.arange(self._pos, self._buffer_size, device=self.device),
+                    torch.arange(0, next_pos, device=self.device),
+                )
             )
         else:
-            idxes = torch.tensor(range(self._pos, next_pos), device=self.device)
+            idxes = torch.arange(self._pos, next_pos, device=self.device)
         if data_len > self._buffer_size:
             data_to_store = data[-self._buffer_size - next_pos :]
         else:
@@ -175,11 +182,7 @@ class ReplayBuffer:
         if self._full:
             first_range_end = self._pos - 1 if sample_next_obs else self._pos
             second_range_end = self.buffer_size if first_range_end >= 0 else self.buffer_size + first_range_end
-            valid_idxes = torch.tensor(
-                list(range(0, first_range_end)) + list(range(self._pos, second_range_end)),
-                device=self.device,
-            )
-            batch_idxes = valid_idxes[torch.randint(0, len(valid_idxes), size=(batch_size,), device=self.device)]
+            batch_idxes = self._sample_valid_idxes(first_range_end, second_range_end, batch_size)
         else:
             max_pos_to_sample = self._pos - 1 if sample_next_obs else self._pos
             if max_pos_to_sample == 0:
@@ -193,6 +196,23 @@ class ReplayBuffer:
             return sample.clone()
         return sample
 
+    def _sample_valid_idxes(self, first_range_end: int, second_range_end: int, n: int) -> Tensor:
+        """Uniformly sample `n` indices from the union of the ranges [0, first_range_end)
+        and [self._pos, second_range_end), without materializing the valid indices.
+
+        Args:
+            first_range_end (int): the end of the first range (a negative value means an empty range).
+            second_range_end (int): the end of the second range.
+            n (int): the number of indices to sample.
+
+        Returns:
+            Tensor: the sampled indices of dimension (n,).
+        """
+        first_range_len = max(first_range_end, 0)
+        n_valid_idxes = first_range_len + second_range_end - self._pos
+        idxes = torch.randint(0, n_valid_idxes, size=(n,), device=self.device)
+        return torch.where(idxes < first_range_len, idxes, idxes + (self._pos - first_range_len))
+
     def _get_samples(self, batch_idxes: Tensor, sample_next_obs: bool = False) -> TensorDictBase:
         env_idxes = torch.randint(0, self.n_envs, size=(len(batch_idxes),))
         if self._buf is None:
@@ -293,17 +313,14 @@ class SequentialReplayBuffer(ReplayBuffer):
             # in (buffer_size + (self._pos - sequence_length + 1)), otherwise the sequence will contain
             # invalid values
             second_range_end = self.buffer_size if first_range_end >= 0 else self.buffer_size + first_range_end
-            valid_idxes = torch.tensor(
-                list(range(0, first_range_end)) + list(range(self._pos, second_range_end)),
-                device=self.device,
-            )
-            if len(valid_idxes) < batch_dim:
+            n_valid_idxes = max(first_range_end, 0) + second_range_end - self._pos
+            if n_valid_idxes < batch_dim:
                 raise ValueError(
-                    f"n_samples * batch size ({batch_dim}) is larger than sampleable items ({len(valid_idxes)}), "
+                    f"n_samples * batch size ({batch_dim}) is larger than sampleable items ({n_valid_idxes}), "
                     "check also sequence_length"
                 )
             # start_idxes are the indices of the first elements of the sequences
-            start_idxes = valid_idxes[torch.randint(0, len(valid_idxes), size=(batch_dim,), device=self.device)]
+            start_idxes = self._sample_valid_idxes(first_range_end, second_range_end, batch_dim)
         else:
             # when the buffer is not full, we need to start the sequence so that it does not go out of bounds
             start_idxes = torch.randint(0, self._pos - sequence_length + 1, size=(batch_dim,), device=self.device)
@@ -332,12 +349,23 @@ class SequentialReplayBuffer(ReplayBuffer):
         unflatten_shape = batch_idxes.shape
         # each sequence must come from the same environment
         env_idxes = (
-            torch.randint(0, self.n_envs, size=(unflatten_shape[0],)).view(-1, 1).repeat(1, unflatten_shape[1]).view(-1)
+            torch.randint(0, self.n_envs, size=(unflatten_shape[0], 1), device=self.device)
+            .expand(unflatten_shape)
+            .reshape(-1)
         )
         # retrieve the items by flattening the indices
         # (b1_s1, b1_s2, b1_s3, ..., bn_s1, bn_s2, bn_s3, ...)
         # where bm_sk is the k-th elements in the sequence of the m-th batch
-        sample = self._buf[batch_idxes.flatten(), env_idxes]
+        if self._memmap:
+            sample = self._buf[batch_idxes.flatten(), env_idxes]
+        else:
+            # a single `index_select` on the (buffer_size * n_envs) flattened storage of every key
+            # is cheaper than the advanced indexing with two index tensors.
+            # The nested keys are retrieved leaf by leaf, since the nested TensorDicts have no `index_select`
+            flat_idxes = batch_idxes.flatten() * self.n_envs + env_idxes
+            sample = TensorDict({}, batch_size=[flat_idxes.numel()], device=self.device)
+            for k, v in self._buf.items(include_nested=True, leaves_only=True):
+                sample.set(k, v.flatten(0, 1).index_select(0, flat_idxes))
         # properly reshape the items:
         # [
         #   [b1_s1, b1_s2, ...],
@@ -485,7 +513,9 @@ class EpisodeBuffer:
                     transfer_ownership=False,
                 )
             episode.memmap_(prefix=episode_dir)
-        episode.to(self.device)
+        else:
+            # moving a memory-mapped episode would copy it into a regular TensorDict
+            episode = episode.to(self.device)
         self._buf.append(episode)
 
     def sample(
@@ -42,6 +42,9 @@ class MLP(nn.Module):
             Defaults to True.
     """
 
+    # Properties are not compiled by TorchScript, so that the module can be scripted with `torch.jit.script`
+    __jit_unused_properties__ = ["model", "output_dim", "flatten_dim"]
+
     def __init__(
         self,
         input_dims: Union[int, Sequence[int]],
@@ -113,9 +116,9 @@ class MLP(nn.Module):
 
     @no_type_check
     def forward(self, obs: Tensor) -> Tensor:
-        if self.flatten_dim is not None:
-            obs = obs.flatten(self.flatten_dim)
-        return self.model(obs)
+        if self._flatten_dim is not None:
+            obs = obs.flatten(self._flatten_dim)
+        return self._model(obs)
 
 
 class CNN(nn.Module):
@@ -327,6 +330,26 @@ class NatureCNN(CNN):
         return x
 
 
+@torch.jit.script
+def _layer_norm_gru_cell_gates(x: Tensor, hx: Tensor) -> Tensor:
+    """Compute the gates of the LayerNormGRUCell and the next hidden state.
+    It is scripted so that the element-wise operations can be fused into a single kernel,
+    both in the forward and in the backward pass.
+
+    Args:
+        x (Tensor): the (normalized) projection of the inputs, of shape (batch_size, 3 * hidden_size).
+        hx (Tensor): the previous hidden state, of shape (batch_size, hidden_size).
+
+    Returns:
+        The next hidden state, computed as update * cand + (1 - update) * hx.
+    """
+    reset, cand, update = x.chunk(3, -1)
+    reset = torch.sigmoid(reset)
+    cand = torch.tanh(reset * cand)
+    update = torch.sigmoid(update - 1)
+    return hx + update * (cand - hx)
+
+
 class LayerNormGRUCell(nn.Module):
     """A GRU cell with a LayerNorm, taken
     from https://github.com/danijar/dreamerv2/blob/main/dreamerv2/common/nets.py#L317.
@@ -388,11 +411,7 @@ class LayerNormGRUCell(nn.Module):
         input = torch.cat((hx, input), -1)
         x = self.linear(input)
         x = self.layer_norm(x)
-        reset, cand, update = torch.chunk(x, 3, -1)
-        reset = torch.sigmoid(reset)
-        cand = torch.tanh(reset * cand)
-        update = torch.sigmoid(update - 1)
-        hx = update * cand + (1 - update) * hx
+        hx = _layer_norm_gru_cell_gates(x, hx)
 
         if not is_batched:
             hx = hx.squeeze(0)
@@ -459,6 +478,24 @@ class MultiEncoder(nn.Module):
             mlp_out = self.mlp_encoder(obs, *args, **kwargs)
         return torch.cat((cnn_out, mlp_out), -1)
 
+    def forward_into(self, obs: Dict[str, Tensor], out: Tensor, *args, **kwargs) -> Tensor:
+        """Encode the observations like the forward method, but write the outputs of the
+        encoders into a pre-allocated tensor, instead of allocating their concatenation.
+
+        Args:
+            obs (Dict[str, Tensor]): the observations to encode.
+            out (Tensor): the tensor with shape (*, output_dim) where to write the embedded observations,
+                it can be a view of a larger tensor.
+
+        Returns:
+            The `out` tensor.
+        """
+        if self.cnn_encoder is not None:
+            out[..., : self.cnn_output_dim].copy_(self.cnn_encoder(obs, *args, **kwargs))
+        if self.mlp_encoder is not None:
+            out[..., self.cnn_output_dim :].copy_(self.mlp_encoder(obs, *args, **kwargs))
+        return out
+
 
 class MultiDecoder(nn.Module):
     def __init__(
@@ -1,12 +1,41 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, Optional, Union
 
 import torch
 from lightning.fabric import Fabric
 from lightning.fabric.plugins.collectives import TorchCollective
+from lightning.fabric.strategies import DDPStrategy, DeepSpeedStrategy, SingleDeviceStrategy
+from lightning_utilities.core.apply_func import apply_to_collection
+from torch import Tensor
 
 from sheeprl.data.buffers import AsyncReplayBuffer, EpisodeBuffer, ReplayBuffer
 
 
+def _state_to_cpu(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy all the tensors of the state to the CPU, so that the state can be written
+    while the training keeps modifying the original tensors.
+    The device-to-host copies are issued asynchronously and awaited once,
+    only if some of the tensors were on a CUDA device.
+
+    Args:
+        state (Dict[str, Any]): the state of the checkpoint.
+
+    Returns:
+        The state with the copies of the tensors on the CPU.
+    """
+    on_cuda = False
+
+    def to_cpu(t: Tensor) -> Tensor:
+        nonlocal on_cuda
+        on_cuda = on_cuda or t.is_cuda
+        return t.detach().to("cpu", non_blocking=True, copy=True)
+
+    state = apply_to_collection(state, Tensor, to_cpu)
+    if on_cuda:
+        torch.cuda.synchronize()
+    return state
+
+
 class CheckpointCallback:
     """Callback to checkpoint the training.
     Three methods are defined to checkpoint the models, the optimizers, and the replay buffers during the training:
@@ -18,8 +47,22 @@ class CheckpointCallback:
             sends the state to the player process (rank-0).
 
     When the buffer is added to the state of the checkpoint, it is assumed that the episode is truncated.
+
+    Args:
+        async_save (bool): whether to write the checkpoints of coupled algorithms in a background thread.
+            The state is copied to the CPU before returning, so that the training can go on while it is written
+            on disk. At most one checkpoint is written at a time. The checkpoints with the replay buffer
+            are always written synchronously, since the buffer keeps being modified by the training.
+            Only the single-device and DDP strategies are supported, where the checkpoint is written
+            by the global zero only.
+            Default to False.
     """
 
+    def __init__(self, async_save: bool = False) -> None:
+        self.async_save = async_save
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending_save: Optional[Future] = None
+
     def on_checkpoint_coupled(
         self,
         fabric: Fabric,
@@ -27,6 +70,23 @@ class CheckpointCallback:
         state: Dict[str, Any],
         replay_buffer: Optional[Union["AsyncReplayBuffer", "ReplayBuffer", "EpisodeBuffer"]] = None,
     ):
+        self.wait_for_pending_save()
+        if self.async_save and replay_buffer is None:
+            strategy = fabric.strategy
+            if not isinstance(strategy, (SingleDeviceStrategy, DDPStrategy)) or isinstance(strategy, DeepSpeedStrategy):
+                raise ValueError(
+                    "The asynchronous checkpoints are supported only by the single-device and DDP strategies, "
+                    f"got: {type(strategy).__name__}"
+                )
+            # Only the global zero saves the checkpoint, as it is done by the `fabric.save` with these strategies
+            if fabric.is_global_zero:
+                state = _state_to_cpu(state)
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1)
+                self._pending_save = self._executor.submit(
+                    fabric.strategy.checkpoint_io.save_checkpoint, state, ckpt_path
+                )
+            return
         if replay_buffer is not None:
             if isinstance(replay_buffer, ReplayBuffer):
                 # clone the true done
@@ -63,6 +123,18 @@ class CheckpointCallback:
             for i, b in enumerate(replay_buffer.buffer):
                 b["dones"][(b._pos - 1) % b.buffer_size, :] = true_dones[i]
 
+    def wait_for_pending_save(self) -> None:
+        """Wait for the checkpoint written in the background, if any, re-raising its exceptions."""
+        if self._pending_save is not None:
+            pending_save, self._pending_save = self._pending_save, None
+            pending_save.result()
+
+    def on_train_end(self) -> None:
+        self.wait_for_pending_save()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
     def on_checkpoint_player(
         self,
         fabric: Fabric,
@@ -1,8 +1,9 @@
 from collections import deque
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 import torch
 from torchmetrics import Metric
+from torchmetrics.aggregation import BaseAggregator
 
 
 class MetricAggregatorException(Exception):
@@ -13,12 +14,22 @@ class MetricAggregator:
     """A metric aggregator class to aggregate metrics to be tracked.
     Args:
         metrics (Optional[Dict[str, Metric]]): Dict of metrics to aggregate.
+        lazy_updates (bool): whether to buffer the tensor values given to the aggregation metrics
+            (e.g. MeanMetric) and to update them all at once before computing them.
+            Every update of an aggregation metric checks its value for NaNs, which synchronizes the host with
+            the device when the value lives on the GPU: buffering the values performs a single check per metric.
+            Defaults to False.
     """
 
-    def __init__(self, metrics: Optional[Dict[str, Metric]] = None):
+    # maximum number of buffered values per metric, after which the metric is updated
+    max_pending_updates: int = 1024
+
+    def __init__(self, metrics: Optional[Dict[str, Metric]] = None, lazy_updates: bool = False):
         self.metrics: Dict[str, Metric] = {}
         if metrics is not None:
             self.metrics = metrics
+        self._lazy_updates = lazy_updates
+        self._pending_updates: Dict[str, List[torch.Tensor]] = {}
 
     def add(self, name: str, metric: Metric):
         """Add a metric to the aggregator
@@ -48,7 +59,29 @@ class MetricAggregator:
         """
         if name not in self.metrics:
             raise MetricAggregatorException(f"Metric {name} does not exist")
-        self.metrics[name].update(value)
+        metric = self.metrics[name]
+        if self._lazy_updates and isinstance(value, torch.Tensor) and isinstance(metric, BaseAggregator):
+            pending = self._pending_updates.setdefault(name, [])
+            pending.append(value.detach().flatten().to(metric.device))
+            if len(pending) >= self.max_pending_updates:
+                self._flush(name)
+        else:
+            metric.update(value)
+
+    @torch.no_grad()
+    def _flush(self, name: Optional[str] = None) -> None:
+        """Update the metrics with their buffered values. Updating an aggregation metric with
+        the concatenation of its values is equivalent to updating it with every value in turn.
+
+        Args:
+            name (str, optional): Name of the metric to update. If None, all the metrics are updated.
+                Defaults to None.
+        """
+        names = list(self._pending_updates.keys()) if name is None else [name]
+        for k in names:
+            values = self._pending_updates.pop(k, None)
+            if values:
+                self.metrics[k].update(torch.cat(values))
 
     def pop(self, name: str) -> None:
         """Remove a metric from the aggregator with the given name
@@ -58,9 +91,11 @@ class MetricAggregator:
         if name not in self.metrics:
             raise MetricAggregatorException(f"Metric {name} does not exist")
         self.metrics.pop(name)
+        self._pending_updates.pop(name, None)
 
     def reset(self):
         """Reset all metrics to their initial state"""
+        self._pending_updates.clear()
         for metric in self.metrics.values():
             metric.reset()
 
@@ -69,6 +104,7 @@ class MetricAggregator:
         Args:
             device (Union[str, torch.device], optional): Device to move the metrics to. Defaults to "cpu".
         """
+        self._flush()
         if self.metrics:
             for k, v in self.metrics.items():
                 self.metrics[k] = v.to(device)
@@ -79,6 +115,7 @@ class MetricAggregator:
         Returns:
             Reduced metrics
         """
+        self._flush()
         reduced_metrics = {}
         if self.metrics:
             for k, v in self.metrics.items():
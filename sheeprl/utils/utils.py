@@ -1,10 +1,42 @@
-from typing import Optional, Tuple
+from typing import Any, Callable, Optional, Sequence, Tuple
 
 import torch
 import torch.nn as nn
+from tensordict import MemmapTensor
 from torch import Tensor
 
 
+@torch.jit.script
+def _gae_advantages(
+    rewards: Tensor,
+    values: Tensor,
+    dones: Tensor,
+    next_value: Tensor,
+    next_done: Tensor,
+    num_steps: int,
+    gamma: float,
+    gae_lambda: float,
+) -> Tensor:
+    """Compute the advantages of the GAE with a backward loop over the steps.
+    It is scripted with TorchScript, so that the loop runs without the Python interpreter.
+    See `gae` for the arguments.
+    """
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = torch.zeros_like(rewards[0])
+    not_done = torch.logical_not(dones)
+    for t in range(num_steps - 1, -1, -1):
+        if t == num_steps - 1:
+            nextnonterminal = torch.logical_not(next_done)
+            nextvalues = next_value
+        else:
+            nextnonterminal = not_done[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+        advantages[t] = lastgaelam
+    return advantages
+
+
 @torch.no_grad()
 def gae(
     rewards: Tensor,
@@ -32,18 +64,13 @@ def gae(
         estimated returns
         estimated advantages
     """
-    advantages = torch.zeros_like(rewards)
-    lastgaelam = 0
-    not_done = torch.logical_not(dones)
-    for t in reversed(range(num_steps)):
-        if t == num_steps - 1:
-            nextnonterminal = torch.logical_not(next_done)
-            nextvalues = next_value
-        else:
-            nextnonterminal = not_done[t + 1]
-            nextvalues = values[t + 1]
-        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
-        advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+    # The scripted function accepts only tensors, while the memory-mapped buffers return memory-mapped tensors
+    rewards, values, dones = [t.as_tensor() if isinstance(t, MemmapTensor) else t for t in (rewards, values, dones)]
+    # The scripted loop writes the advantages of each step in place, so the values of the step after
+    # the last one must have the same shape of a step (e.g. (N_envs, 1) instead of (1, N_envs, 1))
+    next_value = next_value.reshape(rewards.shape[1:])
+    next_done = next_done.reshape(rewards.shape[1:])
+    advantages = _gae_advantages(rewards, values, dones, next_value, next_done, num_steps, gamma, gae_lambda)
     returns = advantages + values
     return returns, advantages
 
@@ -58,6 +85,10 @@ def compute_lambda_values(
 ) -> Tensor:
     """
     Compute the lambda values by keeping the gradients of the variables.
+    The lambda value of the t-th step is L_t = a_t + b_t * L_(t+1), with a_t the reward plus the discounted
+    bootstrapped value and b_t = lmbda * done_mask[t]. Instead of iterating backward over the horizon,
+    the recursion is expanded as L_t = sum_(k >= t) (b_t * ... * b_(k-1)) * a_k, whose coefficients are
+    obtained with one cumulative product over a (horizon - 1, horizon - 1) matrix of discounts.
 
     Args:
         rewards (Tensor): the estimated rewards in the latent space.
@@ -72,18 +103,20 @@ def compute_lambda_values(
     Returns:
         The tensor of the computed lambda values.
     """
-    last_values = torch.clone(last_values)
-    last_lambda_values = 0
-    lambda_targets = []
-    for step in reversed(range(horizon - 1)):
-        if step == horizon - 2:
-            next_values = last_values
-        else:
-            next_values = values[step + 1] * (1 - lmbda)
-        delta = rewards[step] + next_values * done_mask[step]
-        last_lambda_values = delta + lmbda * done_mask[step] * last_lambda_values
-        lambda_targets.append(last_lambda_values)
-    return torch.stack(list(reversed(lambda_targets)), dim=0)
+    steps = horizon - 1
+    next_values = torch.cat((values[1:steps] * (1 - lmbda), last_values.unsqueeze(0)), dim=0)
+    done_mask = done_mask[:steps]
+    inputs = rewards[:steps] + next_values * done_mask
+    # discounts[k] = b_(k-1), the first one is never used
+    discounts = torch.cat((torch.ones_like(done_mask[:1]), lmbda * done_mask[:-1]), dim=0)
+    idxes = torch.arange(steps, device=inputs.device)
+    view_shape = (steps, steps) + (1,) * (inputs.dim() - 1)
+    # factors[t, k] = b_(k-1) if k > t else 1, the cumulative product over k gives b_t * ... * b_(k-1)
+    factors = torch.where(
+        (idxes[None, :] > idxes[:, None]).view(view_shape), discounts.unsqueeze(0), torch.ones_like(discounts)
+    )
+    weights = torch.cumprod(factors, dim=1) * (idxes[None, :] >= idxes[:, None]).view(view_shape)
+    return (weights * inputs.unsqueeze(0)).sum(dim=1)
 
 
 def init_weights(m: nn.Module):
@@ -131,3 +164,36 @@ def symlog(x: Tensor) -> Tensor:
 
 def symexp(x: Tensor) -> Tensor:
     return torch.sign(x) * (torch.exp(torch.abs(x)) - 1)
+
+
+def compile_train_fn(
+    fn: Callable,
+    mode: str = "default",
+    modes: Sequence[str] = ("default", "reduce-overhead", "max-autotune"),
+    **compile_kwargs: Any,
+) -> Callable:
+    """
+    Compile the training function of an algorithm with `torch.compile`, as selected by
+    the `compile_train` and `compile_train_mode` arguments.
+
+    Args:
+        fn (Callable): the function to be compiled.
+        mode (str): the `torch.compile` mode.
+            Default to "default".
+        modes (Sequence[str]): the modes supported by the algorithm.
+            Default to ("default", "reduce-overhead", "max-autotune").
+        compile_kwargs (Any): the other arguments forwarded to `torch.compile`.
+
+    Returns:
+        The compiled function.
+
+    Raises:
+        RuntimeError: if the installed PyTorch does not provide `torch.compile`.
+        ValueError: if the mode is not one of the supported modes.
+    """
+    if not hasattr(torch, "compile"):
+        raise RuntimeError(f"`compile_train` requires PyTorch 2.0 or later, got: {torch.__version__}")
+    if mode not in modes:
+        supported = ", ".join(f"'{m}'" for m in modes)
+        raise ValueError(f"`compile_train_mode` must be one of {supported}, got: {mode}")
+    return torch.compile(fn, mode=mode, **compile_kwargs)
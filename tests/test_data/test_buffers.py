@@ -48,6 +48,42 @@ def test_replay_buffer_add_tds():
     torch.testing.assert_close(rb["t"][2:4], td2["t"])
 
 
+def test_replay_buffer_add_exactly_full():
+    buf_size = 5
+    n_envs = 2
+    rb = ReplayBuffer(buf_size, n_envs)
+    td1 = TensorDict({"t": torch.rand(2, n_envs, 1)}, batch_size=[2, n_envs])
+    td2 = TensorDict({"t": torch.rand(3, n_envs, 1)}, batch_size=[3, n_envs])
+    rb.add(td1)
+    assert not rb.full
+    assert rb._pos == 2
+    rb.add(td2)
+    assert rb.full
+    assert rb._pos == 0
+    torch.testing.assert_close(rb["t"], torch.cat((td1["t"], td2["t"])))
+
+
+def test_replay_buffer_add_wrap_around_after_exactly_full():
+    buf_size = 5
+    n_envs = 2
+    rb = ReplayBuffer(buf_size, n_envs)
+    td1 = TensorDict({"t": torch.rand(5, n_envs, 1)}, batch_size=[5, n_envs])
+    rb.add(td1)
+    assert rb.full
+    assert rb._pos == 0
+    td2 = TensorDict({"t": torch.rand(3, n_envs, 1)}, batch_size=[3, n_envs])
+    rb.add(td2)
+    assert rb.full
+    assert rb._pos == 3
+    torch.testing.assert_close(rb["t"], torch.cat((td2["t"], td1["t"][3:])))
+    # the data is written up to the end of the buffer and then from its beginning
+    td3 = TensorDict({"t": torch.rand(4, n_envs, 1)}, batch_size=[4, n_envs])
+    rb.add(td3)
+    assert rb.full
+    assert rb._pos == 2
+    torch.testing.assert_close(rb["t"], torch.cat((td3["t"][2:], td2["t"][2:], td3["t"][:2])))
+
+
 def test_replay_buffer_add_tds_exceeding_buf_size_multiple_times():
     buf_size = 7
     n_envs = 1
@@ -131,6 +167,37 @@ def test_replay_buffer_sample_full():
     assert s.shape == torch.Size([6, 1])
 
 
+def test_replay_buffer_sample_valid_idxes_full():
+    buf_size = 10
+    n_envs = 1
+    rb = ReplayBuffer(buf_size, n_envs)
+    td1 = TensorDict({"observations": torch.arange(15).view(-1, 1, 1)}, batch_size=[15, n_envs])
+    rb.add(td1)
+    assert rb.full
+    assert rb._pos == 5
+    idxes = rb._sample_valid_idxes(3, buf_size, 1000)
+    assert set(idxes.tolist()) == {0, 1, 2, 5, 6, 7, 8, 9}
+    # the last added observation has not a next observation
+    s = rb.sample(1000, sample_next_obs=True)
+    assert set(s["observations"].flatten().tolist()) == set(range(5, 14))
+    torch.testing.assert_close(s["next_observations"], s["observations"] + 1)
+
+
+def test_replay_buffer_sample_valid_idxes_empty_first_range():
+    buf_size = 10
+    n_envs = 1
+    rb = ReplayBuffer(buf_size, n_envs)
+    td1 = TensorDict({"observations": torch.arange(10).view(-1, 1, 1)}, batch_size=[10, n_envs])
+    rb.add(td1)
+    assert rb.full
+    assert rb._pos == 0
+    idxes = rb._sample_valid_idxes(-1, buf_size - 1, 1000)
+    assert set(idxes.tolist()) == set(range(9))
+    s = rb.sample(1000, sample_next_obs=True)
+    assert set(s["observations"].flatten().tolist()) == set(range(9))
+    torch.testing.assert_close(s["next_observations"], s["observations"] + 1)
+
+
 def test_replay_buffer_sample_one_element():
     buf_size = 1
     n_envs = 1
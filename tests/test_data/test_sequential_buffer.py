@@ -109,6 +109,34 @@ def test_seq_replay_buffer_sample_full_large_sl():
     assert not torch.logical_and((samples["t"][:, 0, :] < rb._pos), (samples["t"][:, -1, :] >= rb._pos)).any()
 
 
+def test_seq_replay_buffer_sample_valid_idxes_full():
+    buf_size = 10
+    n_envs = 1
+    seq_len = 3
+    rb = SequentialReplayBuffer(buf_size, n_envs)
+    t = TensorDict({"t": torch.arange(15).reshape(-1, 1, 1)}, batch_size=[15, n_envs])
+    rb.add(t)
+    assert rb._pos == 5
+    samples = torch.cat([rb.sample(8, sequence_length=seq_len)["t"][0] for _ in range(100)], dim=-1)
+    # the sequences cannot contain the position of the last added element followed by the oldest one
+    assert (samples[1:] - samples[:-1] == 1).all()
+    assert set(samples[0].flatten().tolist()) == {5, 6, 7, 8, 9, 10, 11, 12}
+
+
+def test_seq_replay_buffer_sample_valid_idxes_empty_first_range():
+    buf_size = 10
+    n_envs = 1
+    seq_len = 3
+    rb = SequentialReplayBuffer(buf_size, n_envs)
+    t = TensorDict({"t": torch.arange(11).reshape(-1, 1, 1)}, batch_size=[11, n_envs])
+    rb.add(t)
+    assert rb._pos == 1
+    # the first range [0, pos - seq_len + 1) is empty
+    samples = torch.cat([rb.sample(8, sequence_length=seq_len)["t"][0] for _ in range(100)], dim=-1)
+    assert (samples[1:] - samples[:-1] == 1).all()
+    assert set(samples[0].flatten().tolist()) == set(range(1, 9))
+
+
 def test_seq_replay_buffer_sampleable_items():
     buf_size = 10
     n_envs = 1
@@ -148,3 +176,25 @@ def test_seq_replay_buffer_sample_no_add():
     rb = SequentialReplayBuffer(buf_size, n_envs)
     with pytest.raises(ValueError, match="No sample has been added"):
         rb.sample(2, sequence_length=5, n_samples=2)
+
+
+def test_seq_replay_buffer_sample_nested_keys():
+    buf_size = 10
+    n_envs = 2
+    rb = SequentialReplayBuffer(buf_size, n_envs)
+    t = TensorDict(
+        {
+            "observations": TensorDict(
+                {"rgb": torch.arange(30).view(15, n_envs, 1), "state": -torch.arange(30).view(15, n_envs, 1)},
+                batch_size=[15, n_envs],
+            ),
+            "t": torch.arange(30).view(15, n_envs, 1),
+        },
+        batch_size=[15, n_envs],
+    )
+    rb.add(t)
+    sample = rb.sample(4, sequence_length=3, n_samples=2)
+    assert sample.shape == torch.Size([2, 3, 4])
+    assert sample["observations"].shape == torch.Size([2, 3, 4])
+    torch.testing.assert_close(sample["observations", "rgb"], sample["t"])
+    torch.testing.assert_close(sample["observations", "state"], -sample["t"])
@@ -0,0 +1,38 @@
+import torch
+
+from sheeprl.algos.dreamer_v1.agent import RecurrentModel, _jit_profiling_executor
+
+
+def test_jit_profiling_executor_is_restored():
+    previous = torch._C._jit_set_profiling_executor(True)
+    try:
+        with _jit_profiling_executor(False):
+            assert not torch._C._jit_set_profiling_executor(False)
+        assert torch._C._jit_set_profiling_executor(True)
+    finally:
+        torch._C._jit_set_profiling_executor(previous)
+
+
+def test_recurrent_model_forward_step_matches_forward():
+    model = RecurrentModel(input_size=6, recurrent_state_size=8)
+    input = torch.rand(1, 4, 6)
+    recurrent_state = torch.rand(1, 4, 8)
+    out, state = model(input, recurrent_state)
+    step_out, step_state = model.forward_step(input, recurrent_state)
+    torch.testing.assert_close(step_out, out)
+    torch.testing.assert_close(step_state, state)
+
+    scripted_out, scripted_state = torch.jit.script(model).forward_step(input, recurrent_state)
+    torch.testing.assert_close(scripted_out, out)
+    torch.testing.assert_close(scripted_state, state)
+
+
+def test_recurrent_model_loads_sequential_mlp_checkpoint():
+    model = RecurrentModel(input_size=6, recurrent_state_size=8)
+    # the checkpoints where the linear layer was the first layer of the `mlp` sequential model
+    state_dict = {k.replace("linear.", "mlp.0."): v + 1 for k, v in model.state_dict().items()}
+    assert "mlp.0.weight" in state_dict and "mlp.0.bias" in state_dict
+    model.load_state_dict(state_dict)
+    torch.testing.assert_close(model.linear.weight, state_dict["mlp.0.weight"])
+    torch.testing.assert_close(model.linear.bias, state_dict["mlp.0.bias"])
+    torch.testing.assert_close(model.rnn.weight_hh_l0, state_dict["rnn.weight_hh_l0"])
@@ -0,0 +1,30 @@
+import torch
+
+from sheeprl.algos.dreamer_v2.agent import RSSM, RecurrentModel
+from sheeprl.models.models import MLP
+
+
+def test_rssm_samples_float32_states_under_autocast():
+    discrete, stochastic, recurrent_state_size, embedded_size, actions_size = 4, 3, 8, 5, 2
+    stochastic_size = discrete * stochastic
+    rssm = RSSM(
+        RecurrentModel(
+            input_size=stochastic_size + actions_size, recurrent_state_size=recurrent_state_size, dense_units=8
+        ),
+        MLP(input_dims=recurrent_state_size + embedded_size, output_dim=stochastic_size, hidden_sizes=[8]),
+        MLP(input_dims=recurrent_state_size, output_dim=stochastic_size, hidden_sizes=[8]),
+        discrete=discrete,
+    )
+    posterior = torch.zeros(1, 2, stochastic, discrete)
+    recurrent_state = torch.zeros(1, 2, recurrent_state_size)
+    actions = torch.rand(1, 2, actions_size)
+    embedded_obs = torch.rand(1, 2, embedded_size)
+    is_first = torch.zeros(1, 2, 1)
+    with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        recurrent_state, posterior, posterior_logits = rssm.dynamic_posterior(
+            posterior, recurrent_state, actions, embedded_obs, is_first
+        )
+        prior_logits, prior = rssm._transition(recurrent_state)
+    assert posterior_logits.dtype == posterior.dtype == torch.float32
+    assert prior_logits.dtype == prior.dtype == torch.float32
+    assert posterior.shape == prior.shape == (1, 2, stochastic, discrete)
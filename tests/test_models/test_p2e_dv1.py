@@ -0,0 +1,40 @@
+import pytest
+import torch
+from torch import nn
+
+from sheeprl.algos.p2e_dv1.agent import ensembles_forward
+from sheeprl.models.models import MLP
+
+
+def test_ensembles_forward_matches_each_ensemble():
+    torch.manual_seed(42)
+    ensembles = nn.ModuleList(
+        [MLP(input_dims=6, output_dim=5, hidden_sizes=(8, 8), activation=nn.ELU) for _ in range(3)]
+    )
+    x = torch.rand(4, 2, 6)
+    out = ensembles_forward(ensembles, x)
+    expected = torch.stack([ens(x) for ens in ensembles])
+    assert out.shape == (3, 4, 2, 5)
+    torch.testing.assert_close(out, expected)
+
+    grads = torch.autograd.grad(out.square().sum(), list(ensembles.parameters()))
+    expected_grads = torch.autograd.grad(expected.square().sum(), list(ensembles.parameters()))
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad)
+
+
+def test_ensembles_forward_with_parametrized_non_linear_layer():
+    ensembles = nn.ModuleList(
+        [
+            MLP(
+                input_dims=6,
+                output_dim=5,
+                hidden_sizes=(8,),
+                norm_layer=nn.LayerNorm,
+                norm_args={"normalized_shape": 8},
+            )
+            for _ in range(2)
+        ]
+    )
+    with pytest.raises(ValueError, match="Only the linear layers"):
+        ensembles_forward(ensembles, torch.rand(4, 6))
@@ -0,0 +1,48 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+from lightning import Fabric
+from lightning.fabric.strategies import DataParallelStrategy
+
+from sheeprl.utils.callback import CheckpointCallback
+
+
+def test_async_checkpoint(tmp_path):
+    fabric = Fabric(accelerator="cpu", devices=1)
+    callback = CheckpointCallback(async_save=True)
+    ckpt_path = os.path.join(tmp_path, "ckpt_1.ckpt")
+    state = {"agent": {"weight": torch.ones(3)}, "global_step": 1}
+    callback.on_checkpoint_coupled(fabric, ckpt_path, state)
+    # the state is copied before returning, so the training can go on while it is written
+    state["agent"]["weight"].add_(1)
+    callback.wait_for_pending_save()
+    checkpoint = fabric.load(ckpt_path)
+    torch.testing.assert_close(checkpoint["agent"]["weight"], torch.ones(3))
+    assert checkpoint["global_step"] == 1
+    callback.on_train_end()
+    assert callback._executor is None
+
+
+def test_async_checkpoint_reraises(tmp_path, monkeypatch):
+    fabric = Fabric(accelerator="cpu", devices=1)
+
+    def save_checkpoint(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(fabric.strategy.checkpoint_io, "save_checkpoint", save_checkpoint)
+    callback = CheckpointCallback(async_save=True)
+    callback.on_checkpoint_coupled(fabric, os.path.join(tmp_path, "ckpt_1.ckpt"), {"global_step": 1})
+    with pytest.raises(RuntimeError, match="disk full"):
+        callback.wait_for_pending_save()
+    # the error is raised only once
+    callback.wait_for_pending_save()
+    callback.on_train_end()
+
+
+def test_async_checkpoint_unsupported_strategy(tmp_path):
+    fabric = SimpleNamespace(strategy=DataParallelStrategy(), is_global_zero=True)
+    callback = CheckpointCallback(async_save=True)
+    with pytest.raises(ValueError, match="single-device and DDP strategies"):
+        callback.on_checkpoint_coupled(fabric, os.path.join(tmp_path, "ckpt_1.ckpt"), {"global_step": 1})
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from sheeprl.algos.dreamer_v2.utils import compute_lambda_values as dv2_compute_lambda_values
+from sheeprl.utils.utils import compute_lambda_values
+
+
+def dv2_lambda_values_loop(rewards, values, continues, bootstrap, horizon, lmbda):
+    agg = bootstrap
+    next_val = torch.cat((values[1:], bootstrap), dim=0)
+    inputs = rewards + continues * next_val * (1 - lmbda)
+    lv = []
+    for i in reversed(range(horizon)):
+        agg = inputs[i] + continues[i] * lmbda * agg
+        lv.append(agg)
+    return torch.cat(list(reversed(lv)), dim=0)
+
+
+@pytest.mark.parametrize("horizon", [1, 2, 15])
+def test_dv2_lambda_values(horizon):
+    torch.manual_seed(42)
+    batch_size = 8
+    rewards = torch.randn(horizon, batch_size, 1)
+    values = torch.randn(horizon, batch_size, 1)
+    continues = torch.rand(horizon, batch_size, 1) * 0.99
+    # some of the imagined states are terminal
+    continues[torch.rand(horizon, batch_size, 1) < 0.3] = 0
+    bootstrap = torch.randn(1, batch_size, 1)
+    lambda_values = dv2_compute_lambda_values(rewards, values, continues, bootstrap, horizon, 0.95)
+    assert lambda_values.shape == (horizon, batch_size, 1)
+    torch.testing.assert_close(
+        lambda_values, dv2_lambda_values_loop(rewards, values, continues, bootstrap, horizon, 0.95)
+    )
+    # without the bootstrap the values after the horizon are zero
+    torch.testing.assert_close(
+        dv2_compute_lambda_values(rewards, values, continues, horizon=horizon, lmbda=0.95),
+        dv2_lambda_values_loop(rewards, values, continues, torch.zeros_like(bootstrap), horizon, 0.95),
+    )
+
+
+def lambda_values_loop(rewards, values, done_mask, last_values, horizon, lmbda):
+    last_lambda_values = 0
+    lambda_targets = []
+    for step in reversed(range(horizon - 1)):
+        if step == horizon - 2:
+            next_values = last_values
+        else:
+            next_values = values[step + 1] * (1 - lmbda)
+        delta = rewards[step] + next_values * done_mask[step]
+        last_lambda_values = delta + lmbda * done_mask[step] * last_lambda_values
+        lambda_targets.append(last_lambda_values)
+    return torch.stack(list(reversed(lambda_targets)), dim=0)
+
+
+@pytest.mark.parametrize("horizon", [2, 3, 15])
+def test_lambda_values(horizon):
+    torch.manual_seed(42)
+    batch_size = 8
+    rewards = torch.randn(horizon, batch_size, 1, requires_grad=True)
+    values = torch.randn(horizon, batch_size, 1, requires_grad=True)
+    done_mask = torch.rand(horizon, batch_size, 1) * 0.99
+    # some of the imagined states are terminal
+    done_mask[torch.rand(horizon, batch_size, 1) < 0.3] = 0
+    lambda_values = compute_lambda_values(rewards, values, done_mask, values[-1], horizon, 0.95)
+    expected = lambda_values_loop(rewards, values, done_mask, values[-1], horizon, 0.95)
+    assert lambda_values.shape == (horizon - 1, batch_size, 1)
+    torch.testing.assert_close(lambda_values, expected)
+    # the gradients flow back to the rewards and the values
+    grads = torch.autograd.grad(lambda_values.sum(), (rewards, values))
+    expected_grads = torch.autograd.grad(expected.sum(), (rewards, values))
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad)
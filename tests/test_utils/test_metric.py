@@ -0,0 +1,50 @@
+import pytest
+import torch
+from torchmetrics import MaxMetric, MeanMetric, SumMetric
+
+from sheeprl.utils.metric import MetricAggregator
+
+
+def make_aggregator(lazy_updates: bool) -> MetricAggregator:
+    return MetricAggregator(
+        {"mean": MeanMetric(), "sum": SumMetric(), "max": MaxMetric(), "popped": MeanMetric()},
+        lazy_updates=lazy_updates,
+    )
+
+
+@pytest.mark.parametrize("max_pending_updates", [1024, 3])
+def test_lazy_updates_match_eager_updates(monkeypatch, max_pending_updates):
+    monkeypatch.setattr(MetricAggregator, "max_pending_updates", max_pending_updates)
+    torch.manual_seed(42)
+    values = [torch.randn(n) for n in (1, 4, 3, 1, 5, 2, 7)]
+    eager, lazy = make_aggregator(False), make_aggregator(True)
+    for aggregator in (eager, lazy):
+        for v in values[:3]:
+            for name in ("mean", "sum", "max", "popped"):
+                aggregator.update(name, v)
+        # the reset discards also the values that have not been aggregated yet
+        aggregator.reset()
+        for v in values[3:]:
+            aggregator.update("mean", v)
+            aggregator.update("sum", v.sum())
+            aggregator.update("max", v)
+            aggregator.update("popped", v)
+            # python scalars are always aggregated eagerly
+            aggregator.update("sum", 1.0)
+        aggregator.pop("popped")
+    eager_metrics, lazy_metrics = eager.compute(), lazy.compute()
+    assert eager_metrics.keys() == lazy_metrics.keys() == {"mean", "sum", "max"}
+    for name, value in eager_metrics.items():
+        assert lazy_metrics[name] == pytest.approx(value)
+    assert lazy._pending_updates == {}
+
+
+def test_lazy_updates_are_flushed_when_full(monkeypatch):
+    monkeypatch.setattr(MetricAggregator, "max_pending_updates", 3)
+    aggregator = MetricAggregator({"mean": MeanMetric()}, lazy_updates=True)
+    for i in range(4):
+        aggregator.update("mean", torch.tensor([float(i)]))
+    # the first three values have been aggregated, the last one is still pending
+    assert len(aggregator._pending_updates["mean"]) == 1
+    assert aggregator.metrics["mean"].compute().item() == pytest.approx(1.0)
+    assert aggregator.compute()["mean"] == pytest.approx(1.5)
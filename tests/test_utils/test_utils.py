@@ -0,0 +1,64 @@
+import pytest
+import torch
+from tensordict import MemmapTensor
+
+from sheeprl.utils.utils import compile_train_fn, gae
+
+
+def gae_loop(rewards, values, dones, next_value, next_done, num_steps, gamma, gae_lambda):
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    not_done = torch.logical_not(dones)
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = torch.logical_not(next_done)
+            nextvalues = next_value
+        else:
+            nextnonterminal = not_done[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+    returns = advantages + values
+    return returns, advantages
+
+
+@pytest.mark.parametrize("memmap", [False, True])
+@pytest.mark.parametrize("next_shape", [(4, 1), (1, 4, 1)])
+def test_gae(memmap, next_shape):
+    torch.manual_seed(42)
+    num_steps, num_envs = 8, 4
+    rewards = torch.randn(num_steps, num_envs, 1)
+    values = torch.randn(num_steps, num_envs, 1)
+    dones = torch.zeros(num_steps, num_envs, 1)
+    # the episodes end in the middle of the rollout and at its last step
+    dones[3, 0] = dones[5, 1] = dones[-1, 2] = 1
+    next_value = torch.randn(next_shape)
+    next_done = torch.zeros(next_shape)
+    next_done.view(-1)[3] = 1
+    expected_returns, expected_advantages = gae_loop(
+        rewards, values, dones, next_value.view(num_envs, 1), next_done.view(num_envs, 1), num_steps, 0.99, 0.95
+    )
+    if memmap:
+        rewards, values, dones = [MemmapTensor.from_tensor(t) for t in (rewards, values, dones)]
+    returns, advantages = gae(rewards, values, dones, next_value, next_done, num_steps, 0.99, 0.95)
+    assert isinstance(returns, torch.Tensor) and isinstance(advantages, torch.Tensor)
+    torch.testing.assert_close(advantages, expected_advantages)
+    torch.testing.assert_close(returns, expected_returns)
+
+
+def test_compile_train_fn_checks_the_mode():
+    with pytest.raises(ValueError, match="must be one of 'default', 'max-autotune', got: reduce-overhead"):
+        compile_train_fn(torch.add, mode="reduce-overhead", modes=("default", "max-autotune"))
+
+
+def test_compile_train_fn_requires_torch_compile(monkeypatch):
+    monkeypatch.delattr(torch, "compile", raising=False)
+    with pytest.raises(RuntimeError, match="requires PyTorch 2.0 or later"):
+        compile_train_fn(torch.add)
+
+
+def test_compile_train_fn_forwards_the_arguments(monkeypatch):
+    calls = []
+    monkeypatch.setattr(torch, "compile", lambda fn, **kwargs: calls.append((fn, kwargs)) or fn, raising=False)
+    assert compile_train_fn(torch.add, mode="max-autotune", dynamic=False) is torch.add
+    assert calls == [(torch.add, {"mode": "max-autotune", "dynamic": False})]